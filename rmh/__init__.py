@@ -0,0 +1 @@
+"""Shared code for the Rate My Hydrograph analyses."""
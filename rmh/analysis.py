@@ -0,0 +1,519 @@
+"""Analysis stages of the paper as a memoized pipeline (see rmh.pipeline).
+
+Usage: `python -m rmh.analysis [target stages ...] [--workers N] [--force stage ...]`
+
+The stages correspond to the notebooks: ratings and hydrographs are loaded once, metrics and features are computed
+once, and the rankings, triangle consistency, and classifiers each write their tables to `--output-dir`. Without
+targets, all tables are created. Stage results are cached in `--cache-dir`, so a re-run only recomputes stages whose
+code or input data changed.
+"""
+import argparse
+import itertools
+import logging
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray
+
+from rmh.embed import ComparisonIndex, embed_windows
+from rmh.explain import partial_dependence, permutation_importance
+from rmh.features import TASKS, task_data
+from rmh.ingest import MANIFEST_FILE_NAME, load_data
+from rmh.pipeline import Pipeline, Stage
+from rmh.reliability import reliability
+from rmh.strata import StratifiedRankings
+
+LOGGER = logging.getLogger(__name__)
+
+OBJECTIVES = ['objective_1/great-lakes/validation-temporal', 'objective_2/great-lakes/validation-temporal']
+TARGET_NAMES = ['num_a_wins', 'num_b_wins', 'num_equal_good', 'num_equal_bad']
+TRIANGLE_OUTCOMES = [
+    'consistent', 'conflict', 'eq_consistent', 'eq_conflict', 'triple_eq_consistent', 'double_eq_conflict'
+]
+# final stages of the pipeline, which write the tables
+TABLES = [
+    'ranking_table', 'pairwise_table', 'triangle_table', 'classifier_table', 'importance_table', 'strata_table',
+    'reliability_table', 'consistency_table'
+]
+
+# median KGE of each model in the GRIP-GL paper
+GRIP_KGES = {
+    'mesh-class-raven': 0.45,
+    'gem-hydro-watroute': 0.46,
+    'mesh-svs-raven': 0.57,
+    'swat-raven': 0.56,
+    'watflood-raven': 0.62,
+    'lbrm-cc-lumped': 0.75,
+    'hymod2-lumped': 0.76,
+    'vic-raven': 0.75,
+    'hmets-lumped': 0.75,
+    'blended-raven': 0.76,
+    'blended-lumped': 0.79,
+    'gr4j-lumped': 0.74,
+    'lstm-lumped': 0.82
+}
+# model names as used during the experiments, mapped to how they are called in the manuscript
+MODEL_NAMES = {
+    'lbrm': 'lbrm-cc-lumped',
+    'ml-lstm': 'lstm-lumped',
+    'gr4j-raven-lp': 'gr4j-lumped',
+    'hmets-raven-lp': 'hmets-lumped',
+    'blended-raven-lp': 'blended-lumped',
+    'blended-raven-sd': 'blended-raven',
+    'hymod2': 'hymod2-lumped',
+}
+
+
+def modelname(model_in: str) -> str:
+    """Convert a model name as used during the experiments into how it is called in the manuscript."""
+    return MODEL_NAMES.get(model_in.lower(), model_in.lower())
+
+
+def load_ratings(ratings_file: str) -> pd.DataFrame:
+    return pd.read_csv(ratings_file, index_col=0)
+
+
+def load_hydrographs(data_dir: str, objectives: List[str]) -> Dict[str, xarray.DataArray]:
+    return {obj: load_data(Path(data_dir) / obj.split('/')[0]).load() for obj in objectives}
+
+
+def rank(df: pd.DataFrame) -> pd.DataFrame:
+    """Number of wins and losses, fraction of equal ratings, and win percentage of each model."""
+    stats = {}
+    for model in pd.unique(df[["model_a", "model_b"]].values.ravel()):
+        # For every rating, exactly one of the num_* columns is 1.
+        lw = df[(df["model_a"] == model) & (df["num_a_wins"] == 1)]
+        ll = df[(df["model_a"] == model) & (df["num_b_wins"] == 1)]
+        rev_lw = df[(df["model_b"] == model) & (df["num_b_wins"] == 1)]
+        rev_ll = df[(df["model_b"] == model) & (df["num_a_wins"] == 1)]
+        eq_good = df[((df["model_b"] == model) | (df["model_a"] == model)) & (df["num_equal_good"] == 1)]
+        eq_bad = df[((df["model_b"] == model) | (df["model_a"] == model)) & (df["num_equal_bad"] == 1)]
+        total = df[((df["model_b"] == model) | (df["model_a"] == model))].shape[0]
+        stats[model] = {
+            'won': lw.shape[0] + rev_lw.shape[0],
+            'lost': ll.shape[0] + rev_ll.shape[0],
+            'equal good': eq_good.shape[0] / total,
+            'equal bad': eq_bad.shape[0] / total,
+            'number of ratings': total
+        }
+
+    stats = pd.DataFrame(stats).T
+    stats.index.name = 'model'
+    stats['win%'] = 100 * stats['won'] / (stats['won'] + stats['lost'])
+    return stats.sort_values(by='win%')
+
+
+def compute_metrics(df: pd.DataFrame, hydrographs: Dict[str, xarray.DataArray]) -> pd.DataFrame:
+    """Metrics of each rated (objective, model, basin, start date)."""
+    from neuralhydrology.evaluation.metrics import calculate_all_metrics, kge, nse
+
+    metric_vals = defaultdict(dict)
+    for obj, model in itertools.product(hydrographs.keys(), df['model_a'].unique()):
+        sub_df = df[(df['objective'] == obj) & ((df['model_a'] == model) | (df['model_b'] == model))]
+        basins_dates = sub_df[['basin', 'start_date', 'end_date']].drop_duplicates()
+        for _, (basin, start_date, end_date) in basins_dates.iterrows():
+            sub_xr = hydrographs[obj].sel(station_id=basin, time=slice(start_date, end_date))
+            obs, sim = sub_xr.sel(model='Q'), sub_xr.sel(model=model)
+            setting_metrics = calculate_all_metrics(obs, sim, datetime_coord='time')
+            setting_metrics['logNSE'] = nse(np.log(obs + 1e-5), np.log(sim + 1e-5))
+            setting_metrics['logKGE'] = kge(np.log(obs + 1e-5), np.log(sim + 1e-5))
+            for metric, val in setting_metrics.items():
+                metric_vals[metric][(obj, model, basin, start_date)] = val
+
+    metric_vals = pd.DataFrame(metric_vals)
+    metric_vals.index = metric_vals.index.set_names(('objective', 'model', 'basin', 'start_date'))
+    return metric_vals
+
+
+def build_features(df: pd.DataFrame, metric_vals: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Series]:
+    """Metrics of model a and b of each rating plus the one-hot task as inputs, and the rating outcome as target."""
+    columns = []
+    for ab in ['a', 'b']:
+        keys = pd.MultiIndex.from_arrays([df['objective'], df[f'model_{ab}'], df['basin'], df['start_date']])
+        ab_metrics = metric_vals.reindex(keys)
+        ab_metrics.index = df.index
+        columns.append(ab_metrics.add_prefix(f'model_{ab}_'))
+    metric_df = pd.concat(columns, axis=1)
+
+    nan_columns = metric_df.columns[metric_df.isna().any(axis=0)]
+    LOGGER.info(f'Dropping columns with NaNs: {", ".join(nan_columns)}')
+    x_in = pd.concat([metric_df.drop(columns=nan_columns), pd.get_dummies(df['task'])], axis=1)
+    y = pd.Series(np.argmax(df[TARGET_NAMES].astype(int).values, axis=1), index=x_in.index)
+    return x_in, y
+
+
+def rankings(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    return {t: rank(df[df["task"] == t] if t != "all combined" else df) for t in ["all combined"] + TASKS}
+
+
+def pairwise_win_rates(df: pd.DataFrame) -> pd.DataFrame:
+    """Win percentage of the row model against the column model."""
+    models = pd.unique(df[['model_a', 'model_b']].values.ravel())
+    matrix = defaultdict(dict)
+    for m1, m2 in itertools.combinations(models, 2):
+        sub_df = df[((df['model_a'] == m1) & (df['model_b'] == m2)) | ((df['model_b'] == m1) & (df['model_a'] == m2))]
+        if len(sub_df) > 0:
+            sub_rank = rank(sub_df)
+            matrix[m1][m2] = sub_rank.loc[m1]['win%']
+            matrix[m2][m1] = sub_rank.loc[m2]['win%']
+    compare_df = pd.DataFrame(matrix).T
+    return compare_df.loc[compare_df.columns]
+
+
+def triangle_consistency(df: pd.DataFrame) -> pd.Series:
+    """Count how consistent the ratings of all model triangles (a, b, c) in the same setting are.
+
+    For every setting (basin, time slice, objective, task) and every triple of models with ratings of all three pairs,
+    we orient the ratings as a vs. b, b vs. c, and c vs. a (+1: first model wins, -1: second model wins, 0: equal). Three
+    wins in the same direction are a cycle (conflict), all other combinations of three wins are consistent. With one
+    equal rating, the triangle is consistent if the two wins point in opposite directions. This is the same
+    classification as in the cycle analysis notebook.
+    """
+    direction = df['num_a_wins'].values - df['num_b_wins'].values
+    edges = defaultdict(list)
+    for setting, model_a, model_b, d in zip(zip(df['basin'], df['start_date'], df['objective'], df['task']),
+                                            df['model_a'], df['model_b'], direction):
+        edges[setting, model_a, model_b].append(d)
+        edges[setting, model_b, model_a].append(-d)
+
+    models_per_setting = defaultdict(set)
+    for setting, model_a, model_b in edges.keys():
+        models_per_setting[setting].add(model_a)
+
+    triangles = []
+    for setting, models in models_per_setting.items():
+        for a, b, c in itertools.combinations(sorted(models), 3):
+            ab, bc, ca = edges.get((setting, a, b)), edges.get((setting, b, c)), edges.get((setting, c, a))
+            if ab is not None and bc is not None and ca is not None:
+                triangles += list(itertools.product(ab, bc, ca))
+    triangles = np.array(triangles).reshape(-1, 3)
+
+    n_equal = (triangles == 0).sum(axis=1)
+    n_same_direction = np.abs(triangles.sum(axis=1))
+    outcome = np.select([
+        (n_equal == 0) & (n_same_direction == 3),
+        (n_equal == 0),
+        (n_equal == 1) & (n_same_direction == 0),
+        (n_equal == 1),
+        (n_equal == 3),
+    ], ['conflict', 'consistent', 'eq_consistent', 'eq_conflict', 'triple_eq_consistent'], 'double_eq_conflict')
+    return pd.Series(outcome).value_counts().reindex(TRIANGLE_OUTCOMES, fill_value=0)
+
+
+def stratified_rankings(df: pd.DataFrame, attributes_file: str, n_quantiles: int) -> StratifiedRankings:
+    """Outcome counts per quantile bin of each basin attribute (see rmh.strata)."""
+    attributes = pd.read_csv(attributes_file, dtype={'basin': str})
+    return StratifiedRankings(df, attributes, n_quantiles=n_quantiles)
+
+
+def fit_folds(features: Tuple[pd.DataFrame, pd.Series], n_estimators: int, max_depth: int) -> Dict[str, List[dict]]:
+    """Fit a random forest that predicts the rating outcome from the metrics for each of 5 folds, per task.
+
+    Returns
+    -------
+    Dict[str, List[dict]]
+        For each task and fold the fitted model, the mean and std that standardize its inputs, and the positional
+        train, validation, and test indices into `task_data(features, task)`.
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import KFold
+
+    folds = {}
+    for task in TASKS:
+        x_sub, y_sub = task_data(features, task)
+
+        # contiguous folds, each with the last 20% of the training fold as validation set, as in the notebook
+        folds[task] = []
+        for idx_train, idx_test in KFold(n_splits=5, shuffle=False).split(x_sub.values):
+            n_train = int(idx_train.shape[0] * 0.8)
+            idx_train, idx_val = idx_train[:n_train], idx_train[n_train:]
+            scale = x_sub.iloc[idx_train].std(axis=0)
+            loc = x_sub.iloc[idx_train].mean(axis=0)
+
+            model = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=0, n_jobs=-1)
+            # fit on arrays, so the explanations in rmh.explain can predict batched numpy inputs
+            model.fit(((x_sub.iloc[idx_train] - loc) / scale).values, y_sub.iloc[idx_train].values)
+            folds[task].append({
+                'model': model,
+                'loc': loc,
+                'scale': scale,
+                'idx_train': idx_train,
+                'idx_val': idx_val,
+                'idx_test': idx_test
+            })
+    return folds
+
+
+def classify(features: Tuple[pd.DataFrame, pd.Series], folds: Dict[str, List[dict]]) -> Dict[str, dict]:
+    """Validation and test classification reports of the fold models, averaged across folds, per task."""
+    from sklearn.metrics import classification_report
+
+    results = {}
+    for task, task_folds in folds.items():
+        x_sub, y_sub = task_data(features, task)
+        reports, test_reports, importances = [], [], []
+        for fold in task_folds:
+            importances.append(pd.Series(fold['model'].feature_importances_, index=x_sub.columns))
+            for indices, task_reports in [(fold['idx_val'], reports), (fold['idx_test'], test_reports)]:
+                y_hat = fold['model'].predict(((x_sub.iloc[indices] - fold['loc']) / fold['scale']).values)
+                task_reports.append(
+                    classification_report(y_sub.iloc[indices],
+                                          y_hat,
+                                          labels=list(range(len(TARGET_NAMES))),
+                                          target_names=TARGET_NAMES,
+                                          output_dict=True,
+                                          zero_division=0))
+
+        results[task] = {
+            'validation': _mean_report(reports),
+            'test': _mean_report(test_reports),
+            'validation_accuracy': np.mean([r['accuracy'] for r in reports]),
+            'test_accuracy': np.mean([r['accuracy'] for r in test_reports]),
+            'feature_importances': pd.concat(importances, axis=1).mean(axis=1),
+        }
+    return results
+
+
+def _mean_report(reports: List[dict]) -> pd.DataFrame:
+    return sum(pd.DataFrame({t: report[t] for t in TARGET_NAMES}) for report in reports) / len(reports)
+
+
+def ranking_table(rank_dfs: Dict[str, pd.DataFrame], output_dir: str) -> Path:
+    """Win percentage per task and model next to the GRIP-GL median KGE (Table 1 of the paper)."""
+    paper_df = pd.concat({t: rank_df['win%'].rename(modelname, axis=0) for t, rank_df in rank_dfs.items()
+                          if t != 'all combined'},
+                         axis=1)
+    model_order = paper_df['overall'].sort_values().index
+    paper_df['Median KGE from GRIP-GL'] = pd.Series(GRIP_KGES)
+    paper_df = paper_df.reindex(model_order)
+    kge_col = paper_df.columns[-1]
+    latex = paper_df.style.format(precision=0, subset=TASKS).format(precision=2, subset=kge_col) \
+        .background_gradient(cmap='PiYG', vmin=0, vmax=100, subset=TASKS) \
+        .to_latex(convert_css=True, siunitx=True, hrules=True)
+    return _write_table(output_dir, 'rankings', paper_df, latex)
+
+
+def pairwise_table(compare_df: pd.DataFrame, rank_dfs: Dict[str, pd.DataFrame], output_dir: str) -> Path:
+    model_order = rank_dfs['overall']['win%'].rename(modelname, axis=0).sort_values().index
+    compare_df = compare_df.rename(modelname, axis=0).rename(modelname, axis=1) \
+        .reindex(model_order, axis=0).reindex(model_order, axis=1)
+    latex = compare_df.style.format(precision=0).background_gradient(cmap='PiYG', vmin=0, vmax=100) \
+        .highlight_null(props='background-color: white; color: white') \
+        .to_latex(convert_css=True, siunitx=True, hrules=True)
+    return _write_table(output_dir, 'pairwise', compare_df, latex)
+
+
+def triangle_table(counts: pd.Series, output_dir: str) -> Path:
+    table = pd.DataFrame({'triangles': counts, 'fraction': counts / counts.sum()})
+    latex = table.style.format(precision=3, subset='fraction').to_latex(hrules=True)
+    return _write_table(output_dir, 'triangles', table, latex)
+
+
+def classifier_table(results: Dict[str, dict], output_dir: str) -> Path:
+    table = pd.DataFrame({
+        task: pd.concat([pd.Series({'accuracy': r['test_accuracy']}), r['test'].loc['f1-score'].add_prefix('f1 ')])
+        for task, r in results.items()
+    })
+    latex = table.style.format(precision=2).to_latex(hrules=True)
+    return _write_table(output_dir, 'classifier', table, latex)
+
+
+def importance_table(importance: pd.DataFrame, dependence: pd.DataFrame, output_dir: str) -> Path:
+    """Permutation importance (accuracy decrease in percentage points) of each metric per task."""
+    mean = importance['importance_mean'].unstack('task')[TASKS] * 100
+    std = importance['importance_std'].unstack('task')[TASKS] * 100
+    mean = mean.sort_values(by='overall', ascending=False)
+    table = mean.round(1).astype(str) + ' ± ' + std.reindex(mean.index).round(1).astype(str)
+    latex = table.style.to_latex(hrules=True)
+    table_file = _write_table(output_dir, 'importance', mean.join(std, rsuffix=' std'), latex)
+    dependence.to_csv(Path(output_dir) / 'partial_dependence.csv')
+    return table_file
+
+
+def neighbour_consistency(embeddings: pd.DataFrame, df: pd.DataFrame, k: int) -> pd.Series:
+    """Fraction of the k most similar rated comparisons (see rmh.embed) that agree with each rating."""
+    return ComparisonIndex(df, embeddings).consistency(k)
+
+
+def consistency_table(consistency: pd.Series, df: pd.DataFrame, output_dir: str) -> Path:
+    """Agreement of the ratings with their most similar rated comparisons, compared to chance agreement per task."""
+    outcome_shares = df.groupby('task')[TARGET_NAMES].mean()
+    table = pd.DataFrame({
+        'ratings': df.groupby('task').size(),
+        'neighbour agreement': consistency.groupby(df['task']).mean(),
+        'chance agreement': (outcome_shares**2).sum(axis=1),
+    }).reindex(TASKS)
+    latex = table.style.format(precision=2, subset=['neighbour agreement', 'chance agreement']).to_latex(hrules=True)
+    return _write_table(output_dir, 'consistency', table, latex)
+
+
+def reliability_table(result: pd.DataFrame, output_dir: str) -> Path:
+    """Krippendorff's alpha and Fleiss' kappa with bootstrap confidence intervals per task."""
+    table = pd.DataFrame({
+        statistic: result[statistic].round(2).astype(str) + ' [' + result[f'{statistic}_low'].round(2).astype(str) +
+        ', ' + result[f'{statistic}_high'].round(2).astype(str) + ']'
+        for statistic in ['alpha', 'kappa']
+    })
+    latex = result[['n_users', 'n_settings', 'n_ratings']].join(table).style.to_latex(hrules=True)
+    return _write_table(output_dir, 'reliability', result, latex)
+
+
+def strata_table(strata: StratifiedRankings, output_dir: str) -> Path:
+    """Overall win percentage of each model (columns) per basin attribute and bin (rows)."""
+    table = pd.concat({a: strata.win_rates(a, task='overall').T for a in strata.attributes}, names=['attribute', 'bin'])
+    table = table.rename(modelname, axis=1)
+    table = table[table.mean().sort_values().index]
+    latex = table.style.format(precision=0, na_rep='--').background_gradient(cmap='PiYG', vmin=0, vmax=100) \
+        .to_latex(convert_css=True, siunitx=True, hrules=True)
+    return _write_table(output_dir, 'strata', table, latex)
+
+
+def _write_table(output_dir: str, name: str, table: pd.DataFrame, latex: str) -> Path:
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    table.to_csv(output_dir / f'{name}.csv')
+    (output_dir / f'{name}.tex').write_text(latex)
+    return output_dir / f'{name}.tex'
+
+
+def build_pipeline(ratings_file: Path,
+                   repeated_ratings_file: Path,
+                   attributes_file: Path,
+                   data_dir: Path,
+                   output_dir: Path,
+                   cache_dir: Path,
+                   n_estimators: int = 1000,
+                   max_depth: int = 10) -> Pipeline:
+    """Pipeline of all analyses.
+
+    Parameters
+    ----------
+    ratings_file : Path
+        Ratings of the first study phase (rankings and classifiers).
+    repeated_ratings_file : Path
+        Ratings of the second study phase, where settings were rated repeatedly (triangle consistency).
+    attributes_file : Path
+        Static basin attributes (rankings stratified by attribute).
+    data_dir : Path
+        Directory with the ingested objective directories (see rmh.ingest).
+    output_dir : Path
+        Directory for the tables.
+    cache_dir : Path
+        Directory for the memoized stage results.
+    n_estimators : int, optional
+        Number of trees of the random forests.
+    max_depth : int, optional
+        Maximum depth of the random forests.
+
+    Returns
+    -------
+    Pipeline
+        Pipeline whose stages write the tables in `TABLES`.
+    """
+    manifests = [data_dir / obj.split('/')[0] / MANIFEST_FILE_NAME for obj in OBJECTIVES]
+    output = {'output_dir': str(output_dir)}
+
+    def table_files(name: str) -> List[Path]:
+        return [output_dir / f'{name}.csv', output_dir / f'{name}.tex']
+
+    return Pipeline([
+        Stage('ratings', load_ratings, params={'ratings_file': str(ratings_file)}, files=[ratings_file]),
+        Stage('repeated_ratings',
+              load_ratings,
+              params={'ratings_file': str(repeated_ratings_file)},
+              files=[repeated_ratings_file]),
+        Stage('hydrographs',
+              load_hydrographs,
+              params={
+                  'data_dir': str(data_dir),
+                  'objectives': OBJECTIVES
+              },
+              files=[m for m in manifests if m.exists()]),
+        Stage('metrics', compute_metrics, inputs=['ratings', 'hydrographs']),
+        Stage('features', build_features, inputs=['ratings', 'metrics']),
+        Stage('embeddings', embed_windows, inputs=['hydrographs', 'ratings']),
+        Stage('consistency', neighbour_consistency, inputs=['embeddings', 'ratings'], params={'k': 10}),
+        Stage('rankings', rankings, inputs=['ratings']),
+        Stage('pairwise', pairwise_win_rates, inputs=['ratings']),
+        Stage('triangles', triangle_consistency, inputs=['repeated_ratings']),
+        Stage('reliability',
+              reliability,
+              inputs=['repeated_ratings'],
+              params={
+                  'by': ['task'],
+                  'n_bootstrap': 2000,
+                  'seed': 0
+              }),
+        Stage('folds', fit_folds, inputs=['features'], params={
+            'n_estimators': n_estimators,
+            'max_depth': max_depth
+        }),
+        Stage('strata',
+              stratified_rankings,
+              inputs=['ratings'],
+              params={
+                  'attributes_file': str(attributes_file),
+                  'n_quantiles': 4
+              },
+              files=[attributes_file]),
+        Stage('classifiers', classify, inputs=['features', 'folds']),
+        Stage('importance', permutation_importance, inputs=['features', 'folds'], params={'n_repeats': 20}),
+        Stage('partial_dependence', partial_dependence, inputs=['features', 'folds'], params={'n_grid': 20}),
+        Stage('ranking_table', ranking_table, inputs=['rankings'], params=output, outputs=table_files('rankings')),
+        Stage('pairwise_table',
+              pairwise_table,
+              inputs=['pairwise', 'rankings'],
+              params=output,
+              outputs=table_files('pairwise')),
+        Stage('triangle_table', triangle_table, inputs=['triangles'], params=output, outputs=table_files('triangles')),
+        Stage('classifier_table',
+              classifier_table,
+              inputs=['classifiers'],
+              params=output,
+              outputs=table_files('classifier')),
+        Stage('importance_table',
+              importance_table,
+              inputs=['importance', 'partial_dependence'],
+              params=output,
+              outputs=table_files('importance') + [output_dir / 'partial_dependence.csv']),
+        Stage('strata_table', strata_table, inputs=['strata'], params=output, outputs=table_files('strata')),
+        Stage('consistency_table',
+              consistency_table,
+              inputs=['consistency', 'ratings'],
+              params=output,
+              outputs=table_files('consistency')),
+        Stage('reliability_table',
+              reliability_table,
+              inputs=['reliability'],
+              params=output,
+              outputs=table_files('reliability')),
+    ],
+                    cache_dir=cache_dir)
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Run the analyses of the paper as a memoized pipeline.')
+    parser.add_argument('targets', nargs='*', default=TABLES, help=f'Stages to compute (default: {" ".join(TABLES)})')
+    parser.add_argument('--ratings', type=Path, default=Path('data/rmh-stage1.csv'))
+    parser.add_argument('--repeated-ratings', type=Path, default=Path('data/rmh-stage2.csv'))
+    parser.add_argument('--attributes', type=Path, default=Path('data/static_attributes.csv'))
+    parser.add_argument('--data-dir', type=Path, default=Path('data'))
+    parser.add_argument('--output-dir', type=Path, default=Path('tables'))
+    parser.add_argument('--cache-dir', type=Path, default=Path('.rmh-cache'))
+    parser.add_argument('--workers', type=int, default=None, help='Number of parallel stages (default: #CPUs)')
+    parser.add_argument('--force', nargs='*', default=[], help='Stages to re-run even if they are cached')
+    parsed = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+    pipeline = build_pipeline(parsed.ratings, parsed.repeated_ratings, parsed.attributes, parsed.data_dir,
+                              parsed.output_dir, parsed.cache_dir)
+    pipeline.run(parsed.targets, n_workers=parsed.workers, force=parsed.force)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
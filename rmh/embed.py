@@ -0,0 +1,227 @@
+"""Shape embeddings of the rated hydrographs and a nearest-neighbour index of the rated comparisons.
+
+`embed_windows` describes every (objective, basin, window, model) hydrograph by a fixed-length vector: its flow duration
+curve and seasonal cycle relative to the observations, and summaries of its normalized residuals. All windows of an
+objective are read from the hydrograph cube with one vectorized selection, and the features are computed for all of them
+at once. `ComparisonIndex` stacks the embeddings of model a and b of each rating into a float32 matrix and finds the
+most similar rated comparisons (exact kNN), in either order of the two models, together with their outcomes:
+
+    embeddings = embed_windows(load_hydrographs('data', OBJECTIVES), ratings)
+    index = ComparisonIndex(ratings, embeddings)
+    index.neighbours(ratings.iloc[:1], k=10)
+"""
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+import xarray
+
+from rmh.ingest import OBS_NAME
+
+# exceedance probabilities of the flow duration curve
+FDC_PROBABILITIES = np.array([0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.8, 0.9, 0.95, 0.99])
+# observations above/below these quantiles are high/low flows
+HIGH_FLOW_QUANTILE, LOW_FLOW_QUANTILE = 0.9, 0.1
+EPS = 1e-5
+OUTCOMES = ['num_a_wins', 'num_b_wins', 'num_equal_good', 'num_equal_bad']
+WINDOW_KEYS = ['objective', 'basin', 'start_date', 'end_date']
+
+
+def embed_windows(hydrographs: Dict[str, xarray.DataArray], ratings: pd.DataFrame) -> pd.DataFrame:
+    """Shape features of each model's hydrograph in each rated window.
+
+    Parameters
+    ----------
+    hydrographs : Dict[str, xarray.DataArray]
+        Hydrographs per objective with dimensions model, station_id, and time, as returned by
+        `rmh.analysis.load_hydrographs`. The observations are the model `Q`.
+    ratings : pd.DataFrame
+        Ratings with the columns objective, basin, start_date, and end_date. Every window that occurs in the ratings is
+        embedded for all models.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per (objective, basin, start_date, end_date, model) and one column per feature. The observations are
+        included as model `Q`, so they can be compared to the simulations.
+    """
+    frames = []
+    for objective, hydrograph in hydrographs.items():
+        windows = ratings.loc[ratings['objective'] == objective, WINDOW_KEYS].drop_duplicates()
+        if len(windows) == 0:
+            continue
+        flows, months = _window_flows(hydrograph, windows)
+        features = _shape_features(flows, months, list(hydrograph['model'].values).index(OBS_NAME))
+        models = hydrograph['model'].values
+        index = pd.MultiIndex.from_tuples([(*window, model) for window in windows.itertuples(index=False)
+                                           for model in models],
+                                          names=WINDOW_KEYS + ['model'])
+        frames.append(pd.DataFrame(np.concatenate(list(features.values()), axis=-1).reshape(len(index), -1),
+                                   index=index,
+                                   columns=[f'{name}_{i}' if values.shape[-1] > 1 else name
+                                            for name, values in features.items() for i in range(values.shape[-1])]))
+    return pd.concat(frames)
+
+
+def _window_flows(hydrograph: xarray.DataArray, windows: pd.DataFrame):
+    # positions of all days of all windows, padded to the longest window
+    times = hydrograph.indexes['time']
+    start_idx = times.get_indexer(pd.to_datetime(windows['start_date']))
+    end_idx = times.get_indexer(pd.to_datetime(windows['end_date']))
+    if (start_idx < 0).any() or (end_idx < 0).any():
+        raise ValueError('Some rated windows are outside the time range of the hydrographs.')
+    steps = np.arange((end_idx - start_idx).max() + 1)
+    time_idx = start_idx[:, None] + steps[None, :]
+    padding = time_idx > end_idx[:, None]
+    time_idx = np.minimum(time_idx, len(times) - 1)
+
+    basin_idx = hydrograph.indexes['station_id'].get_indexer(windows['basin'])
+    if (basin_idx < 0).any():
+        raise ValueError(f'Unknown basins {", ".join(windows["basin"][basin_idx < 0].unique())}')
+    # one vectorized selection of all windows: [model, window, step]
+    flows = hydrograph.isel(station_id=xarray.DataArray(basin_idx, dims='window'),
+                            time=xarray.DataArray(time_idx, dims=('window', 'step'))).values.astype(np.float64)
+    flows[:, padding] = np.nan
+    flows[flows < 0] = np.nan
+    return np.moveaxis(flows, 0, 1), times.month.values[time_idx]  # [window, model, step], [window, step]
+
+
+def _shape_features(flows: np.ndarray, months: np.ndarray, obs_idx: int) -> Dict[str, np.ndarray]:
+    """Features of flows [window, model, step], relative to the observations, as arrays [window, model, n_values]."""
+    obs = flows[:, [obs_idx]]
+    obs_mean = np.nanmean(obs, axis=-1, keepdims=True)
+    obs_std = np.nanstd(obs, axis=-1, keepdims=True)
+
+    # flow duration curve and seasonal cycle on a log scale, relative to the mean observed flow
+    fdc = np.nanquantile(flows, 1 - FDC_PROBABILITIES, axis=-1)  # [probabilities, window, model]
+    fdc = np.log((np.moveaxis(fdc, 0, -1) + EPS) / (obs_mean + EPS))
+    month_one_hot = months[:, None, :, None] == np.arange(1, 13)  # [window, 1, step, month]
+    valid = ~np.isnan(flows)[..., None]
+    monthly_sum = np.einsum('wmsk,wms->wmk', (month_one_hot & valid).astype(np.float64), np.nan_to_num(flows))
+    monthly_mean = monthly_sum / np.maximum((month_one_hot & valid).sum(axis=2), 1)
+    seasonal = np.log((monthly_mean + EPS) / (obs_mean + EPS))
+
+    # residuals normalized by the observed variability, overall and in high and low flows
+    residuals = (flows - obs) / (obs_std + EPS)
+    high = obs >= np.nanquantile(obs, HIGH_FLOW_QUANTILE, axis=-1, keepdims=True)
+    low = obs <= np.nanquantile(obs, LOW_FLOW_QUANTILE, axis=-1, keepdims=True)
+    sim_anomaly = flows - np.nanmean(flows, axis=-1, keepdims=True)
+    obs_anomaly = obs - obs_mean
+    correlation = np.nanmean(sim_anomaly * obs_anomaly, axis=-1) / (np.nanstd(flows, axis=-1) * obs_std[..., 0] + EPS)
+    # day-to-day changes describe the flashiness of the hydrograph
+    flashiness = np.nanmean(np.abs(np.diff(flows, axis=-1)), axis=-1) / (obs_mean[..., 0] + EPS)
+    return {
+        'fdc': fdc,
+        'seasonal': seasonal,
+        'residual_mean': np.nanmean(residuals, axis=-1)[..., None],
+        'residual_std': np.nanstd(residuals, axis=-1)[..., None],
+        'residual_high': _masked_mean(residuals, high)[..., None],
+        'residual_low': _masked_mean(residuals, low)[..., None],
+        'correlation': correlation[..., None],
+        'flashiness': np.log(flashiness + EPS)[..., None],
+    }
+
+
+def _masked_mean(values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    mask = np.broadcast_to(mask, values.shape) & ~np.isnan(values)
+    return np.where(mask, values, 0).sum(axis=-1) / np.maximum(mask.sum(axis=-1), 1)
+
+
+class ComparisonIndex:
+    """Exact nearest-neighbour search over the rated comparisons.
+
+    A comparison is the embedding of model a followed by the embedding of model b, standardized per feature and stored
+    as float32. Queries are compared to all ratings in both orders of the two models, and each rating counts once, in the
+    closer of the two orders. So a rating of (x, y) also finds the ratings of (y, x); for those, the outcome is reported
+    from the query's perspective (a and b swapped).
+
+    Parameters
+    ----------
+    ratings : pd.DataFrame
+        Ratings with the window columns, model_a, model_b, and the outcome columns.
+    embeddings : pd.DataFrame
+        Window embeddings as returned by `embed_windows`.
+    """
+
+    def __init__(self, ratings: pd.DataFrame, embeddings: pd.DataFrame):
+        embeddings = embeddings.dropna(axis=1, how='any')
+        self.loc = embeddings.mean()
+        self.scale = embeddings.std().replace(0, 1)
+        self.embeddings = ((embeddings - self.loc) / self.scale).astype(np.float32)
+        self.ratings = ratings
+        self.matrix = self._comparisons(ratings)
+        # the same comparisons with a and b swapped
+        half = self.embeddings.shape[1]
+        self.swapped = np.ascontiguousarray(np.concatenate([self.matrix[:, half:], self.matrix[:, :half]], axis=1))
+        self._norms = (self.matrix**2).sum(axis=1)
+
+    def _comparisons(self, ratings: pd.DataFrame) -> np.ndarray:
+        halves = []
+        for ab in ['a', 'b']:
+            keys = pd.MultiIndex.from_arrays([ratings[k] for k in WINDOW_KEYS] + [ratings[f'model_{ab}']])
+            halves.append(self.embeddings.reindex(keys).values)
+        matrix = np.concatenate(halves, axis=1)
+        if np.isnan(matrix).any():
+            raise ValueError('Some rated windows or models are missing from the embeddings.')
+        return matrix.astype(np.float32)
+
+    def neighbours(self, queries: pd.DataFrame, k: int = 10, block_size: int = 1024) -> pd.DataFrame:
+        """The k most similar rated comparisons of each query rating.
+
+        Parameters
+        ----------
+        queries : pd.DataFrame
+            Ratings to look up, with the same columns as the indexed ratings. A query that is itself in the index is
+            not returned as its own neighbour.
+        k : int, optional
+            Number of neighbours per query.
+        block_size : int, optional
+            Number of queries whose distances are computed in one matrix product.
+
+        Returns
+        -------
+        pd.DataFrame
+            k rows per query, ordered by distance: query (index label of the query), neighbour (index label of the
+            rating in the index), distance, swapped (whether the neighbour compared the models in the opposite order),
+            and the neighbour's outcome columns from the query's perspective.
+        """
+        query_matrix = self._comparisons(queries)
+        k = min(k, len(self.ratings) - 1)
+        results = []
+        for start in range(0, len(queries), block_size):
+            block = query_matrix[start:start + block_size]
+            block_norms = (block**2).sum(axis=1)[:, None]
+            # squared euclidean distances to all comparisons, in the model order that is closer to the query
+            direct = block_norms + self._norms[None, :] - 2 * block @ self.matrix.T
+            reverse = block_norms + self._norms[None, :] - 2 * block @ self.swapped.T
+            block_swapped = reverse < direct
+            distances = np.minimum(direct, reverse)  # [queries, ratings]
+            own = self.ratings.index.get_indexer(queries.index[start:start + block_size])
+            rows = np.nonzero(own >= 0)[0]
+            distances[rows, own[rows]] = np.inf
+
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(distances, nearest, axis=1)), axis=1)
+            results.append((start + np.repeat(np.arange(len(block)), k), nearest.ravel(),
+                            np.take_along_axis(distances, nearest, axis=1).ravel(),
+                            np.take_along_axis(block_swapped, nearest, axis=1).ravel()))
+
+        query_pos, rating_pos, distances, swapped = map(np.concatenate, zip(*results))
+        outcomes = self.ratings[OUTCOMES].values[rating_pos]
+        outcomes[swapped] = outcomes[swapped][:, [1, 0, 2, 3]]
+        result = pd.DataFrame({
+            'query': queries.index.values[query_pos],
+            'neighbour': self.ratings.index.values[rating_pos],
+            'distance': np.sqrt(np.maximum(distances, 0)),
+            'swapped': swapped,
+        })
+        result[OUTCOMES] = outcomes
+        return result
+
+    def consistency(self, k: int = 10) -> pd.Series:
+        """Fraction of each rating's k nearest comparisons whose outcome agrees with the rating."""
+        neighbours = self.neighbours(self.ratings, k=k)
+        own_outcome = np.argmax(self.ratings[OUTCOMES].values, axis=1)
+        query_pos = self.ratings.index.get_indexer(neighbours['query'])
+        agrees = np.argmax(neighbours[OUTCOMES].values, axis=1) == own_outcome[query_pos]
+        return pd.Series(agrees, index=neighbours['query']).groupby(level=0).mean().reindex(self.ratings.index)
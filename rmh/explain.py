@@ -0,0 +1,188 @@
+"""Permutation importance and partial dependence of the rating classifiers.
+
+Both reuse the fold models of `rmh.analysis.fit_folds` instead of training new ones. Each metric enters the classifier
+twice (`model_a_<metric>` and `model_b_<metric>`), so we treat both columns as one block: the permutation importance of a
+metric permutes both columns with the same row permutation, and its partial dependence is the average of varying the
+metric of model a (effect on "a wins") and of model b (effect on "b wins"). All permutations or grid values of one
+(task, fold, metric) are predicted in a single batched call, and these jobs are spread over a process pool.
+"""
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from rmh.features import task_data
+
+# class indices of the rating outcome, as in rmh.analysis.TARGET_NAMES
+A_WINS, B_WINS, EQUAL_GOOD, EQUAL_BAD = range(4)
+PD_OUTCOMES = ['rated model wins', 'other model wins', 'equal good', 'equal bad']
+
+# features and fold models, set once per worker process by _init_worker
+_WORKER_STATE = {}
+
+
+def metric_groups(columns: List[str]) -> Dict[str, List[str]]:
+    """Map each metric to its input columns, i.e., `model_a_<metric>` and `model_b_<metric>`."""
+    groups = defaultdict(list)
+    for column in columns:
+        for prefix in ['model_a_', 'model_b_']:
+            if column.startswith(prefix):
+                groups[column[len(prefix):]].append(column)
+                break
+        else:
+            groups[column].append(column)
+    return dict(groups)
+
+
+def permutation_importance(features: Tuple[pd.DataFrame, pd.Series],
+                           folds: Dict[str, List[dict]],
+                           n_repeats: int = 20,
+                           split: str = 'idx_test',
+                           n_workers: int = None,
+                           seed: int = 0) -> pd.DataFrame:
+    """Decrease in accuracy of the fold models when the columns of a metric are permuted.
+
+    Parameters
+    ----------
+    features : Tuple[pd.DataFrame, pd.Series]
+        Inputs and targets as returned by `rmh.analysis.build_features`.
+    folds : Dict[str, List[dict]]
+        Fold models per task as returned by `rmh.analysis.fit_folds`.
+    n_repeats : int, optional
+        Number of permutations per fold and metric.
+    split : str, optional
+        Indices of each fold to evaluate on: 'idx_test' (default) or 'idx_val'.
+    n_workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    seed : int, optional
+        Seed of the permutations.
+
+    Returns
+    -------
+    pd.DataFrame
+        Importance per task and metric (both a and b columns): mean and std of the accuracy decrease across all folds
+        and repeats, and the mean accuracy without permutation.
+    """
+    jobs = [(task, fold_idx, metric, columns) for task, task_folds in folds.items()
+            for fold_idx in range(len(task_folds))
+            for metric, columns in metric_groups(list(task_data(features, task)[0].columns)).items()]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(features, folds)) as executor:
+        results = list(
+            executor.map(_permutation_job, *zip(*jobs), [n_repeats] * len(jobs), [split] * len(jobs),
+                         [seed + i for i in range(len(jobs))]))
+
+    rows = []
+    for (task, fold_idx, metric, _), (baseline, permuted) in zip(jobs, results):
+        rows += [{'task': task, 'metric': metric, 'baseline': baseline, 'importance': baseline - p} for p in permuted]
+    rows = pd.DataFrame(rows)
+    return rows.groupby(['task', 'metric']).agg(importance_mean=('importance', 'mean'),
+                                                importance_std=('importance', 'std'),
+                                                baseline_accuracy=('baseline', 'mean'))
+
+
+def partial_dependence(features: Tuple[pd.DataFrame, pd.Series],
+                       folds: Dict[str, List[dict]],
+                       n_grid: int = 20,
+                       n_workers: int = None) -> pd.DataFrame:
+    """Average predicted outcome probabilities as a function of one model's metric value.
+
+    The grid consists of `n_grid` quantiles of the metric across both columns. For each grid value, we set the metric of
+    model a to the value on all ratings of the task and average the predicted probability that a wins ("rated model
+    wins"), that b wins ("other model wins"), and of the equal outcomes. The same is done for model b with the roles of a
+    and b swapped, and both are averaged, as are the folds.
+
+    Parameters
+    ----------
+    features : Tuple[pd.DataFrame, pd.Series]
+        Inputs and targets as returned by `rmh.analysis.build_features`.
+    folds : Dict[str, List[dict]]
+        Fold models per task as returned by `rmh.analysis.fit_folds`.
+    n_grid : int, optional
+        Number of grid values per metric.
+    n_workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    pd.DataFrame
+        Probability of each outcome in `PD_OUTCOMES` per task, metric, and grid value.
+    """
+    jobs = []
+    for task, task_folds in folds.items():
+        x_sub, _ = task_data(features, task)
+        for metric, columns in metric_groups(list(x_sub.columns)).items():
+            grid = np.unique(np.nanquantile(x_sub[columns].values, np.linspace(0, 1, n_grid)))
+            jobs += [(task, fold_idx, metric, columns, grid) for fold_idx in range(len(task_folds))]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(features, folds)) as executor:
+        results = list(executor.map(_partial_dependence_job, *zip(*jobs)))
+
+    frames = [
+        pd.DataFrame(probabilities, columns=PD_OUTCOMES).assign(task=task, metric=metric, value=grid)
+        for (task, _, metric, _, grid), probabilities in zip(jobs, results)
+    ]
+    return pd.concat(frames).groupby(['task', 'metric', 'value'])[PD_OUTCOMES].mean()
+
+
+def _init_worker(features: Tuple[pd.DataFrame, pd.Series], folds: Dict[str, List[dict]]):
+    _WORKER_STATE['features'] = features
+    _WORKER_STATE['folds'] = folds
+    for task_folds in folds.values():
+        for fold in task_folds:
+            # the pool already uses all cores, so each prediction runs single-threaded
+            fold['model'].set_params(n_jobs=1)
+
+
+def _standardized(task: str, fold_idx: int) -> Tuple[dict, np.ndarray, np.ndarray]:
+    fold = _WORKER_STATE['folds'][task][fold_idx]
+    x_sub, y_sub = task_data(_WORKER_STATE['features'], task)
+    return fold, ((x_sub - fold['loc']) / fold['scale']), y_sub.values
+
+
+def _predict_proba(model, x: np.ndarray) -> np.ndarray:
+    # folds without examples of an outcome have fewer classes, so we map the predictions to all four outcomes
+    probabilities = np.zeros((x.shape[0], len(PD_OUTCOMES)))
+    probabilities[:, model.classes_] = model.predict_proba(x)
+    return probabilities
+
+
+def _permutation_job(task: str, fold_idx: int, metric: str, columns: List[str], n_repeats: int, split: str,
+                     seed: int) -> Tuple[float, np.ndarray]:
+    fold, x_std, y = _standardized(task, fold_idx)
+    column_idx = [x_std.columns.get_loc(c) for c in columns]
+    x = x_std.values[fold[split]]
+    y = y[fold[split]]
+    n = x.shape[0]
+
+    rng = np.random.default_rng(seed)
+    permutations = np.argsort(rng.random((n_repeats, n)), axis=1)
+    stacked = np.tile(x, (n_repeats + 1, 1))
+    # the first block is the unpermuted baseline, then one block per repeat
+    for repeat, permutation in enumerate(permutations, start=1):
+        stacked[repeat * n:(repeat + 1) * n, column_idx] = x[permutation][:, column_idx]
+
+    correct = (_predict_proba(fold['model'], stacked).argmax(axis=1) == np.tile(y, n_repeats + 1))
+    accuracies = correct.reshape(n_repeats + 1, n).mean(axis=1)
+    return accuracies[0], accuracies[1:]
+
+
+def _partial_dependence_job(task: str, fold_idx: int, metric: str, columns: List[str], grid: np.ndarray) -> np.ndarray:
+    fold, x_std, _ = _standardized(task, fold_idx)
+    x = x_std.values
+    n = x.shape[0]
+
+    blocks, swapped = [], []
+    for column in columns:
+        column_idx = x_std.columns.get_loc(column)
+        scaled_grid = (grid - fold['loc'][column]) / fold['scale'][column]
+        stacked = np.tile(x, (len(grid), 1))
+        stacked[:, column_idx] = np.repeat(scaled_grid, n)
+        blocks.append(stacked)
+        swapped.append(column.startswith('model_b_'))
+
+    probabilities = _predict_proba(fold['model'], np.concatenate(blocks)).reshape(len(columns), len(grid), n, -1)
+    probabilities = probabilities.mean(axis=2)  # [columns, grid, outcomes]
+    # for model b's metric, "rated model wins" is the probability that b wins
+    probabilities[swapped] = probabilities[swapped][..., [B_WINS, A_WINS, EQUAL_GOOD, EQUAL_BAD]]
+    return probabilities.mean(axis=0)
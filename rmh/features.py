@@ -0,0 +1,12 @@
+"""Classifier inputs that are shared by the rating classifiers (`rmh.analysis`) and their explanations (`rmh.explain`)."""
+from typing import Tuple
+
+import pandas as pd
+
+TASKS = ['overall', 'high-flow', 'low-flow']
+
+
+def task_data(features: Tuple[pd.DataFrame, pd.Series], task: str) -> Tuple[pd.DataFrame, pd.Series]:
+    """Inputs (without the task columns) and targets of the ratings of one task."""
+    x_in, y = features
+    return x_in[x_in[task] == 1].drop(TASKS, axis=1), y[x_in[task] == 1]
@@ -0,0 +1,275 @@
+"""Ingest GRIP-GL observations and model simulations into a manifest-backed store.
+
+Usage: `python -m rmh.ingest data/objective_1 [data/objective_2 ...] [--workers N]`
+
+Each objective directory contains `all_gauges.nc` (observations) and `model/<model name>/*.nc` (simulations). The
+ingestion validates each netCDF file (station ids, time axis, units), converts it to a compressed, chunked netCDF file in
+`<objective>/store/` with `station_id` as dimension, and records it in `<objective>/manifest.json`. Files that are
+already in the manifest and haven't changed are skipped, so adding a model only converts that model. Models whose
+directory was deleted or whose file could not be converted are removed from the manifest and the store. `load_data`
+reads the manifest and returns the same DataArray that the notebooks and the website used to build from the raw files.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray
+
+LOGGER = logging.getLogger(__name__)
+
+Q_VAR_NAME = 'Q'
+BASIN_VAR_NAME = 'station_id'
+DATE_VAR_NAME = 'time'
+STATION_DIM = 'nstations'
+
+OBS_FILE_NAME = 'all_gauges.nc'
+OBS_NAME = 'Q'
+MANIFEST_FILE_NAME = 'manifest.json'
+STORE_DIR_NAME = 'store'
+MANIFEST_VERSION = 1
+# one chunk holds one year of daily data for one station, so reading a time slice of a basin touches few chunks
+CHUNK_DAYS = 366
+
+
+def load_data(base_dir: Path) -> xarray.DataArray:
+    """Load observations and all model simulations of one objective from its manifest.
+
+    Parameters
+    ----------
+    base_dir : Path
+        Objective directory that contains the manifest.
+
+    Returns
+    -------
+    xarray.DataArray
+        Discharge with dimensions model, station_id, and time. The observations are the model `Q`.
+    """
+    manifest = read_manifest(base_dir)
+    if manifest is None:
+        raise ValueError(f'Manifest not found in {base_dir}. Run `python -m rmh.ingest {base_dir}` first.')
+
+    hydrographs = {OBS_NAME: xarray.load_dataset(base_dir / manifest['observations']['store'])[Q_VAR_NAME]}
+    for model_name, entry in manifest['models'].items():
+        hydrographs[model_name] = xarray.open_dataset(base_dir / entry['store'])[Q_VAR_NAME]
+
+    hydrograph_xr = xarray.concat(hydrographs.values(), dim='model', join='outer')
+    hydrograph_xr['model'] = list(hydrographs.keys())
+    return hydrograph_xr
+
+
+def read_manifest(base_dir: Path) -> Optional[dict]:
+    manifest_file = base_dir / MANIFEST_FILE_NAME
+    if not manifest_file.exists():
+        return None
+    with manifest_file.open('r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'Unsupported manifest version {manifest.get("version")} in {manifest_file}')
+    return manifest
+
+
+def ingest(base_dir: Path, n_workers: int = None) -> Tuple[List[str], Dict[str, str]]:
+    """Add new or changed observation and model files of one objective to its store and manifest.
+
+    Parameters
+    ----------
+    base_dir : Path
+        Objective directory with `all_gauges.nc` and `model/<model name>/*.nc`.
+    n_workers : int, optional
+        Number of processes that convert the model files. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    Tuple[List[str], Dict[str, str]]
+        Names of the ingested models, and error messages of the models that could not be ingested. Models that could
+        not be ingested are not in the manifest, even if an earlier version of their file was ingested before.
+    """
+    obs_file = base_dir / OBS_FILE_NAME
+    if not obs_file.exists():
+        raise ValueError(f'Observations netCDF file not found at {obs_file}')
+    (base_dir / STORE_DIR_NAME).mkdir(exist_ok=True)
+    manifest = read_manifest(base_dir) or {'version': MANIFEST_VERSION, 'observations': None, 'models': {}}
+
+    # the observations define the valid station ids, time axis, and units. If they change, we re-validate all models.
+    obs_sha256 = _sha256(obs_file)
+    if manifest['observations'] is None or manifest['observations']['source_sha256'] != obs_sha256:
+        manifest['observations'] = _convert(obs_file, base_dir, OBS_NAME, reference=None)
+        manifest['models'] = {}
+        _write_manifest(base_dir, manifest)
+    reference = manifest['observations']
+
+    model_dirs = sorted(d for d in base_dir.glob('model/*') if d.is_dir())
+    for model_name in set(manifest['models']) - {d.name for d in model_dirs}:
+        LOGGER.info(f'Removing {model_name}, its directory no longer exists.')
+        _remove_model(base_dir, manifest, model_name)
+
+    sources, errors = {}, {}
+    for model_dir in model_dirs:
+        model_nc = sorted(model_dir.glob('*.nc'))
+        if len(model_nc) != 1:
+            errors[model_dir.name] = f'Found {len(model_nc)} files for model {model_dir.name}, expected one.'
+            LOGGER.error(f'Could not ingest {model_dir.name}: {errors[model_dir.name]}')
+            _remove_model(base_dir, manifest, model_dir.name)
+            continue
+        entry = manifest['models'].get(model_dir.name)
+        if entry is not None and entry['source_sha256'] == _sha256(model_nc[0]) \
+                and (base_dir / entry['store']).exists():
+            continue
+        sources[model_dir.name] = model_nc[0]
+
+    ingested = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            model_name: executor.submit(_convert, source, base_dir, model_name, reference)
+            for model_name, source in sources.items()
+        }
+        for model_name, future in futures.items():
+            try:
+                manifest['models'][model_name] = future.result()
+            except (ValueError, OSError) as exception:
+                errors[model_name] = str(exception)
+                LOGGER.error(f'Could not ingest {model_name}: {exception}')
+                # don't keep serving the previous version of a file that was replaced by an invalid one
+                _remove_model(base_dir, manifest, model_name)
+                continue
+            ingested.append(model_name)
+            LOGGER.info(f'Ingested {model_name} from {sources[model_name]}')
+
+    manifest['models'] = dict(sorted(manifest['models'].items()))
+    _write_manifest(base_dir, manifest)
+    return ingested, errors
+
+
+def validate(hydrograph: xarray.Dataset, name: str, reference: Optional[dict]):
+    """Check that a netCDF file has the station ids, time axis, and units that the analyses expect.
+
+    Parameters
+    ----------
+    hydrograph : xarray.Dataset
+        Dataset with the discharge variable and `station_id` as dimension.
+    name : str
+        Name of the file's model, used in error messages.
+    reference : dict, optional
+        Manifest entry of the observations. If provided, the stations must be a subset of the observed stations, the
+        time axis must overlap the observations, and the units must match.
+
+    Raises
+    ------
+    ValueError
+        If the file is invalid.
+    """
+    if Q_VAR_NAME not in hydrograph:
+        raise ValueError(f'{name}: variable {Q_VAR_NAME} missing')
+    if set(hydrograph[Q_VAR_NAME].dims) != {BASIN_VAR_NAME, DATE_VAR_NAME}:
+        raise ValueError(f'{name}: expected dimensions {BASIN_VAR_NAME} and {DATE_VAR_NAME}, '
+                         f'got {hydrograph[Q_VAR_NAME].dims}')
+
+    stations = pd.Index(hydrograph[BASIN_VAR_NAME].values.astype(str))
+    if stations.has_duplicates:
+        raise ValueError(f'{name}: duplicate station ids {list(stations[stations.duplicated()])}')
+
+    dates = pd.DatetimeIndex(hydrograph[DATE_VAR_NAME].values)
+    if len(dates) < 2 or not (dates[1:] - dates[:-1] == pd.Timedelta(days=1)).all():
+        raise ValueError(f'{name}: time axis is not a contiguous daily series')
+
+    units = hydrograph[Q_VAR_NAME].attrs.get('units')
+    if units is None:
+        LOGGER.warning(f'{name}: {Q_VAR_NAME} has no units attribute')
+
+    if reference is not None:
+        unknown_stations = stations.difference(reference['stations'])
+        if len(unknown_stations) > 0:
+            raise ValueError(f'{name}: stations without observations: {list(unknown_stations)}')
+        if dates[-1] < pd.Timestamp(reference['start']) or dates[0] > pd.Timestamp(reference['end']):
+            raise ValueError(f'{name}: time axis {dates[0]}-{dates[-1]} does not overlap the observations')
+        if units is not None and reference['units'] is not None and units != reference['units']:
+            raise ValueError(f'{name}: units {units} differ from the observations ({reference["units"]})')
+
+
+def _convert(source: Path, base_dir: Path, name: str, reference: Optional[dict]) -> dict:
+    hydrograph = xarray.load_dataset(source)
+    # netcdfs only have a numeric dimension "nstations" that maps to the station_id variable.
+    # for easier processing, we directly make the station_id the dimension.
+    if STATION_DIM in hydrograph.dims:
+        hydrograph = hydrograph.swap_dims({STATION_DIM: BASIN_VAR_NAME})
+    validate(hydrograph, name, reference)
+
+    hydrograph = hydrograph[[Q_VAR_NAME]].transpose(BASIN_VAR_NAME, DATE_VAR_NAME)
+    hydrograph[BASIN_VAR_NAME] = hydrograph[BASIN_VAR_NAME].values.astype(str)
+    store = Path(STORE_DIR_NAME) / f'{name}.nc'
+    encoding = {
+        Q_VAR_NAME: {
+            'dtype': 'float32',
+            'zlib': True,
+            'complevel': 4,
+            'chunksizes': (1, min(CHUNK_DAYS, hydrograph.sizes[DATE_VAR_NAME])),
+            '_FillValue': np.float32(np.nan),
+        }
+    }
+    # write to a temporary file first, so an interrupted ingestion never leaves a broken store behind
+    tmp_file = base_dir / store.with_suffix('.nc.tmp')
+    try:
+        hydrograph.to_netcdf(tmp_file, encoding=encoding)
+    except (ValueError, OSError):
+        tmp_file.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_file, base_dir / store)
+
+    dates = pd.DatetimeIndex(hydrograph[DATE_VAR_NAME].values)
+    return {
+        'source': str(source.relative_to(base_dir)),
+        'source_sha256': _sha256(source),
+        'store': str(store),
+        'stations': list(hydrograph[BASIN_VAR_NAME].values),
+        'start': dates[0].strftime('%Y-%m-%d'),
+        'end': dates[-1].strftime('%Y-%m-%d'),
+        'units': hydrograph[Q_VAR_NAME].attrs.get('units'),
+    }
+
+
+def _remove_model(base_dir: Path, manifest: dict, model_name: str):
+    entry = manifest['models'].pop(model_name, None)
+    if entry is not None:
+        (base_dir / entry['store']).unlink(missing_ok=True)
+
+
+def _write_manifest(base_dir: Path, manifest: dict):
+    tmp_file = base_dir / f'{MANIFEST_FILE_NAME}.tmp'
+    with tmp_file.open('w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, base_dir / MANIFEST_FILE_NAME)
+
+
+def _sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Ingest GRIP-GL netCDF files into the manifest-backed store.')
+    parser.add_argument('objective_dirs', type=Path, nargs='+', help='Objective directories, e.g. data/objective_1')
+    parser.add_argument('--workers', type=int, default=None, help='Number of conversion processes (default: #CPUs)')
+    parsed = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+    n_errors = 0
+    for base_dir in parsed.objective_dirs:
+        ingested, errors = ingest(base_dir, n_workers=parsed.workers)
+        LOGGER.info(f'{base_dir}: ingested {len(ingested)} models, {len(errors)} failed.')
+        n_errors += len(errors)
+    return 1 if n_errors > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""Minimal DAG runner with on-disk memoization for the analyses.
+
+Each stage is a module-level function whose positional arguments are the results of its input stages. A stage's cache
+key is a hash of its name, its code, its parameters, the content of the files it reads, and the keys of its input
+stages. Results are pickled to `<cache dir>/<stage>-<key>.pkl`, so a stage only re-runs if its code, parameters, or
+input data changed, and everything downstream of an unchanged stage is loaded from the cache. Stages that write files,
+e.g., tables, also re-run if one of their output files was deleted or changed since they wrote it. Stages whose inputs
+are available run in parallel processes.
+
+The code of a stage is the source of its function, plus the source of the functions and classes and the values of the
+constants from the same package (e.g., `rmh`) that it uses, recursively and across modules. Changes to other packages,
+e.g., library updates, are not detected. In this case, bump the stage's `version`.
+"""
+import hashlib
+import inspect
+import json
+import logging
+import pickle
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from types import CodeType
+from typing import Any, Callable, Dict, List, Sequence
+
+LOGGER = logging.getLogger(__name__)
+# code from this package is part of the stages' cache keys
+PACKAGE = __name__.split('.')[0]
+
+
+class Stage:
+    """One step of a pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the stage.
+    function : Callable
+        Module-level function (so it can be run in another process). It is called with the results of `inputs` as
+        positional arguments and with `params` as keyword arguments.
+    inputs : Sequence[str], optional
+        Names of the stages whose results this stage needs.
+    params : dict, optional
+        JSON-serializable keyword arguments of `function`.
+    files : Sequence[Path], optional
+        Files that the stage reads. Their content is part of the cache key.
+    outputs : Sequence[Path], optional
+        Files that the stage writes. A cached result only counts if these files still have the content the stage wrote.
+    version : int, optional
+        Increase to invalidate cached results, e.g., after a library update that changes the results.
+    """
+
+    def __init__(self,
+                 name: str,
+                 function: Callable,
+                 inputs: Sequence[str] = (),
+                 params: dict = None,
+                 files: Sequence[Path] = (),
+                 outputs: Sequence[Path] = (),
+                 version: int = 0):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.params = params if params is not None else {}
+        self.files = [Path(f) for f in files]
+        self.outputs = [Path(f) for f in outputs]
+        self.version = version
+
+
+class Pipeline:
+    """Set of stages that form a directed acyclic graph.
+
+    Parameters
+    ----------
+    stages : List[Stage]
+        Stages of the pipeline. Inputs must refer to stages in this list.
+    cache_dir : Path
+        Directory for the memoized stage results.
+    """
+
+    def __init__(self, stages: List[Stage], cache_dir: Path):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        for stage in stages:
+            unknown = [name for name in stage.inputs if name not in self.stages]
+            if len(unknown) > 0:
+                raise ValueError(f'Stage {stage.name} has unknown inputs {unknown}')
+        self._order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        order, visiting = [], set()
+
+        def visit(name: str):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f'Pipeline has a cycle through stage {name}')
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            visiting.remove(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def dependencies(self, targets: Sequence[str]) -> List[str]:
+        """Names of the targets and all stages they depend on, in topological order."""
+        needed = set()
+        stack = list(targets)
+        while len(stack) > 0:
+            name = stack.pop()
+            if name not in self.stages:
+                raise ValueError(f'Unknown stage {name}')
+            if name not in needed:
+                needed.add(name)
+                stack += self.stages[name].inputs
+        return [name for name in self._order if name in needed]
+
+    def keys(self, names: Sequence[str]) -> Dict[str, str]:
+        """Cache keys of the given stages, which must include all their dependencies."""
+        keys = {}
+        for name in names:
+            stage = self.stages[name]
+            description = {
+                'name': name,
+                'version': stage.version,
+                'code': code_fingerprint(stage.function),
+                'params': stage.params,
+                'files': {str(f): _file_hash(f) for f in stage.files},
+                'inputs': [keys[input_name] for input_name in stage.inputs],
+            }
+            encoded = json.dumps(description, sort_keys=True, default=str).encode('utf-8')
+            keys[name] = hashlib.sha256(encoded).hexdigest()[:16]
+        return keys
+
+    def result_file(self, name: str, key: str) -> Path:
+        return self.cache_dir / f'{name}-{key}.pkl'
+
+    def is_cached(self, name: str, result_file: Path) -> bool:
+        """Whether a stage's result is cached and the files it wrote are unchanged."""
+        if not result_file.exists():
+            return False
+        outputs = self.stages[name].outputs
+        if len(outputs) == 0:
+            return True
+        outputs_file = _outputs_file(result_file)
+        if not outputs_file.exists() or not all(f.exists() for f in outputs):
+            return False
+        with outputs_file.open('r') as f:
+            written = json.load(f)
+        return written == {str(f): _file_hash(f) for f in outputs}
+
+    def run(self, targets: Sequence[str], n_workers: int = None, force: Sequence[str] = ()) -> Dict[str, Path]:
+        """Run the targets and every stage they depend on that has no cached result.
+
+        Parameters
+        ----------
+        targets : Sequence[str]
+            Names of the stages to compute.
+        n_workers : int, optional
+            Number of processes that run stages in parallel. Defaults to the number of CPUs.
+        force : Sequence[str], optional
+            Stages to re-run even if their result is cached.
+
+        Returns
+        -------
+        Dict[str, Path]
+            File with the pickled result of each target and dependency. Use `load` to read it.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        names = self.dependencies(targets)
+        keys = self.keys(names)
+        files = {name: self.result_file(name, keys[name]) for name in names}
+
+        done = {name for name in names if name not in force and self.is_cached(name, files[name])}
+        for name in done:
+            LOGGER.info(f'{name}: cached ({files[name].name})')
+        pending = [name for name in names if name not in done]
+
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            running = {}
+            while len(pending) > 0 or len(running) > 0:
+                ready = [name for name in pending if all(i in done for i in self.stages[name].inputs)]
+                for name in ready:
+                    stage = self.stages[name]
+                    LOGGER.info(f'{name}: running')
+                    running[executor.submit(_run_stage, stage.function, [files[i] for i in stage.inputs],
+                                            stage.params, files[name], stage.outputs)] = name
+                    pending.remove(name)
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()  # re-raises the stage's exception
+                    done.add(name)
+                    LOGGER.info(f'{name}: done ({files[name].name})')
+        return files
+
+
+def code_fingerprint(function: Callable) -> Dict[str, str]:
+    """Source of a function and of the functions, classes, and constants of its package that it refers to."""
+    fingerprint = {}
+    stack = [function]
+    while len(stack) > 0:
+        current = stack.pop()
+        name = f'{_module_name(current)}.{current.__qualname__}'
+        if name in fingerprint:
+            continue
+        fingerprint[name] = inspect.getsource(current)
+        # a class is followed through the code of its methods
+        functions = [current] if inspect.isfunction(current) else \
+            [value for value in vars(current).values() if inspect.isfunction(value)]
+        for referenced_function in functions:
+            for referenced_name in _referenced_names(referenced_function.__code__):
+                value = referenced_function.__globals__.get(referenced_name)
+                constant_name = f'{_module_name(referenced_function)}.{referenced_name}'
+                if (inspect.isfunction(value) or inspect.isclass(value)) \
+                        and _module_name(value).split('.')[0] == PACKAGE:
+                    stack.append(value)
+                elif isinstance(value, (str, int, float, bool, list, tuple, dict)):
+                    fingerprint[constant_name] = repr(value)
+                elif type(value).__module__ == 'numpy' and hasattr(value, 'tolist'):
+                    # numpy's repr abbreviates large arrays
+                    fingerprint[constant_name] = repr(value.tolist())
+    return fingerprint
+
+
+def _module_name(value: Any) -> str:
+    # with `python -m rmh.analysis`, the functions of rmh.analysis belong to __main__
+    module = sys.modules.get(value.__module__)
+    spec = getattr(module, '__spec__', None)
+    return spec.name if value.__module__ == '__main__' and spec is not None else value.__module__
+
+
+def _referenced_names(code: CodeType) -> List[str]:
+    # global names are in co_names of the function and of its nested code objects (comprehensions, lambdas, ...)
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names += _referenced_names(const)
+    return names
+
+
+def load(result_file: Path) -> Any:
+    """Load a stage result that was written by `Pipeline.run`."""
+    with result_file.open('rb') as f:
+        return pickle.load(f)
+
+
+def _run_stage(function: Callable, input_files: List[Path], params: dict, result_file: Path, outputs: List[Path]):
+    result = function(*[load(f) for f in input_files], **params)
+    if len(outputs) > 0:
+        with _outputs_file(result_file).open('w') as f:
+            json.dump({str(output): _file_hash(output) for output in outputs}, f)
+    # write to a temporary file first, so an interrupted run never leaves a broken cache entry behind
+    tmp_file = result_file.with_suffix('.tmp')
+    with tmp_file.open('wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_file.replace(result_file)
+
+
+def _outputs_file(result_file: Path) -> Path:
+    # hashes of the files that the stage wrote, next to its result
+    return result_file.with_suffix('.outputs.json')
+
+
+def _file_hash(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
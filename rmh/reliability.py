@@ -0,0 +1,267 @@
+"""Chance-corrected inter-rater reliability of the ratings with user-level bootstrap confidence intervals.
+
+Usage: `python -m rmh.reliability data/rmh-stage2.csv [--by task] [--bootstrap 2000] [--output reliability.csv]`
+
+A setting is one (objective, basin, window, task, pair of models); the two models are brought into a fixed order, so
+ratings of (x, y) and (y, x) count for the same setting. The ratings are integer-coded into a count array of shape
+[users, settings, outcomes]. Krippendorff's alpha (nominal) and Fleiss' kappa are computed from the pairs of ratings of
+the same setting by different users, weighted by how often each user counts. A batch of weight vectors evaluates all
+leave-one-user-out sets or a block of bootstrap replicates (users drawn with replacement) at once with a few matrix
+products. Bootstrap blocks are spread over a process pool.
+"""
+import argparse
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+OUTCOME_COLUMNS = ['num_a_wins', 'num_b_wins', 'num_equal_good', 'num_equal_bad']
+SETTING_COLUMNS = ['objective', 'basin', 'start_date', 'end_date', 'task']
+BLOCK_SIZE = 100
+
+# user counts per group, set once per worker process by _init_worker
+_WORKER_STATE = {}
+
+
+def user_counts(ratings: pd.DataFrame) -> Tuple[np.ndarray, pd.Index]:
+    """Integer-coded ratings: how often each user gave each outcome in each setting.
+
+    Parameters
+    ----------
+    ratings : pd.DataFrame
+        Ratings with the setting columns, model_a, model_b, user_id, and the outcome columns.
+
+    Returns
+    -------
+    Tuple[np.ndarray, pd.Index]
+        Counts of shape [users, settings, outcomes] and the user ids. Only settings that were rated by at least two
+        users are kept, since the others carry no information about agreement between raters.
+    """
+    swap = (ratings['model_a'] > ratings['model_b']).values
+    first = np.where(swap, ratings['model_b'], ratings['model_a'])
+    second = np.where(swap, ratings['model_a'], ratings['model_b'])
+    outcome = np.argmax(ratings[OUTCOME_COLUMNS].values, axis=1)
+    # in the fixed model order, "a wins" and "b wins" of swapped ratings change places
+    outcome = np.where(swap & (outcome < 2), 1 - outcome, outcome)
+
+    settings = pd.MultiIndex.from_arrays([ratings[c] for c in SETTING_COLUMNS] + [first, second])
+    setting_idx, _ = pd.factorize(settings)
+    user_idx, users = pd.factorize(ratings['user_id'])
+    counts = np.zeros((len(users), setting_idx.max() + 1, len(OUTCOME_COLUMNS)), dtype=np.int32)
+    np.add.at(counts, (user_idx, setting_idx, outcome), 1)
+    n_users = (counts.sum(axis=2) > 0).sum(axis=0)
+    return counts[:, n_users >= 2], pd.Index(users, name='user_id')
+
+
+def krippendorff_alpha(counts: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+    """Krippendorff's alpha for nominal data.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Outcome counts per user and setting, shape [users, settings, outcomes], as returned by `user_counts`.
+    weights : np.ndarray, optional
+        How often each user counts, shape [..., users]. Defaults to once.
+
+    Returns
+    -------
+    np.ndarray
+        Alpha for each set of weights, shape [...].
+    """
+    ratings, pair_rows, pair_diagonal, pair_total = _pairs(counts, weights)
+    # coincidence matrix: each setting contributes its number of ratings, split among its pairs
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(pair_total > 0, ratings.sum(axis=-1) / pair_total, 0)
+        agreement = (scale * pair_diagonal).sum(axis=-1)
+        n_outcome = (scale[..., None] * pair_rows).sum(axis=-2)
+        n = n_outcome.sum(axis=-1)
+        return 1 - (n - 1) * (n - agreement) / (n**2 - (n_outcome**2).sum(axis=-1))
+
+
+def fleiss_kappa(counts: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+    """Fleiss' kappa, for settings with different numbers of ratings.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Outcome counts per user and setting, shape [users, settings, outcomes], as returned by `user_counts`.
+    weights : np.ndarray, optional
+        How often each user counts, shape [..., users]. Defaults to once.
+
+    Returns
+    -------
+    np.ndarray
+        Kappa for each set of weights, shape [...].
+    """
+    ratings, _, pair_diagonal, pair_total = _pairs(counts, weights)
+    pairable = pair_total > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        observed = np.where(pairable, pair_diagonal / pair_total, 0).sum(axis=-1) / pairable.sum(axis=-1)
+        proportions = (ratings * pairable[..., None]).sum(axis=-2)
+        proportions = proportions / proportions.sum(axis=-1, keepdims=True)
+        expected = (proportions**2).sum(axis=-1)
+        return (observed - expected) / (1 - expected)
+
+
+def _pairs(counts: np.ndarray, weights: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Ordered pairs of ratings of the same setting by different users.
+
+    Pairs of ratings by the same user are excluded. This makes no difference for users who rated each setting at most
+    once, but it keeps a bootstrap replicate that draws a user several times from pairing the user with their copies.
+    Returns the weighted ratings [..., settings, outcomes] and, per setting, the pairs by outcome of the first rating
+    [..., settings, outcomes], the pairs with equal outcomes [..., settings], and all pairs [..., settings].
+    """
+    counts = counts.astype(np.float64)
+    n_users, n_settings, n_outcomes = counts.shape
+    weights = np.ones(n_users) if weights is None else np.asarray(weights, dtype=np.float64)
+    user_ratings = counts.sum(axis=-1)  # [users, settings]
+    # per user: all combinations of its own ratings, which are removed below
+    own = np.concatenate([counts * user_ratings[..., None], (counts**2).sum(axis=-1, keepdims=True),
+                          user_ratings[..., None]**2],
+                         axis=-1).reshape(n_users, -1)
+
+    batch_shape = weights.shape[:-1]
+    weights = weights.reshape(-1, n_users)
+    ratings = (weights @ counts.reshape(n_users, -1)).reshape(-1, n_settings, n_outcomes)
+    own = (weights**2 @ own).reshape(-1, n_settings, n_outcomes + 2)
+    total_ratings = ratings.sum(axis=-1)
+    pair_rows = ratings * total_ratings[..., None] - own[..., :n_outcomes]
+    pair_diagonal = (ratings**2).sum(axis=-1) - own[..., n_outcomes]
+    pair_total = total_ratings**2 - own[..., n_outcomes + 1]
+    return tuple(x.reshape(batch_shape + x.shape[1:]) for x in [ratings, pair_rows, pair_diagonal, pair_total])
+
+
+def leave_one_out(ratings: pd.DataFrame) -> pd.DataFrame:
+    """Reliability without each user, to find the raters that lower or raise agreement the most.
+
+    Returns
+    -------
+    pd.DataFrame
+        Per user: number of ratings in settings with several raters, alpha and kappa without the user, and the change
+        compared to all users (positive: agreement is higher without the user).
+    """
+    counts, users = user_counts(ratings)
+    without = 1 - np.eye(len(users))  # [users left out, users]
+    result = pd.DataFrame(
+        {
+            'n_ratings': counts.sum(axis=(1, 2)),
+            'alpha': krippendorff_alpha(counts, without),
+            'kappa': fleiss_kappa(counts, without),
+        }, index=users)
+    result['alpha_change'] = result['alpha'] - krippendorff_alpha(counts)
+    result['kappa_change'] = result['kappa'] - fleiss_kappa(counts)
+    return result.sort_values(by='alpha_change', ascending=False)
+
+
+def reliability(ratings: pd.DataFrame,
+                by: List[str] = None,
+                n_bootstrap: int = 1000,
+                confidence: float = 0.95,
+                n_workers: int = None,
+                seed: int = None) -> pd.DataFrame:
+    """Krippendorff's alpha and Fleiss' kappa with user-level bootstrap confidence intervals.
+
+    Parameters
+    ----------
+    ratings : pd.DataFrame
+        Ratings with the setting columns, model_a, model_b, user_id, and the outcome columns.
+    by : List[str], optional
+        Columns to group the ratings by, e.g., ['task'] or ['occupation']. Without groups, all ratings are evaluated
+        together.
+    n_bootstrap : int, optional
+        Number of bootstrap replicates per group. A replicate draws as many users as the group has, with replacement,
+        and includes all their ratings. Copies of the same user are never paired with each other.
+    confidence : float, optional
+        Coverage of the percentile confidence intervals.
+    n_workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    seed : int, optional
+        Seed of the bootstrap.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per group with the numbers of users, pairable settings, and their ratings, and alpha and kappa with
+        lower and upper confidence bounds.
+    """
+    groups = {key if isinstance(key, tuple) else (key, ): group
+              for key, group in ratings.groupby(by)} if by else {('all', ): ratings}
+    counts = {key: user_counts(group)[0] for key, group in groups.items()}
+    counts = {key: group_counts for key, group_counts in counts.items() if group_counts.shape[1] > 0}
+
+    seeds = np.random.SeedSequence(seed).spawn(len(counts) * int(np.ceil(n_bootstrap / BLOCK_SIZE)))
+    jobs = [(key, min(BLOCK_SIZE, n_bootstrap - start)) for key in counts for start in range(0, n_bootstrap, BLOCK_SIZE)]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(counts, )) as executor:
+        results = list(executor.map(_bootstrap_job, *zip(*jobs), seeds))
+
+    replicates = {key: [] for key in counts}
+    for (key, _), block in zip(jobs, results):
+        replicates[key].append(block)
+
+    tail = (1 - confidence) / 2 * 100
+    rows = []
+    for key, group_counts in counts.items():
+        alphas, kappas = np.concatenate(replicates[key], axis=1)
+        rows.append({
+            **dict(zip(by if by else ['group'], key)),
+            'n_users': int((group_counts.sum(axis=(1, 2)) > 0).sum()),
+            'n_settings': group_counts.shape[1],
+            'n_ratings': int(group_counts.sum()),
+            'alpha': krippendorff_alpha(group_counts),
+            'alpha_low': np.nanpercentile(alphas, tail),
+            'alpha_high': np.nanpercentile(alphas, 100 - tail),
+            'kappa': fleiss_kappa(group_counts),
+            'kappa_low': np.nanpercentile(kappas, tail),
+            'kappa_high': np.nanpercentile(kappas, 100 - tail),
+        })
+    return pd.DataFrame(rows).set_index(by if by else ['group'])
+
+
+def _init_worker(counts: dict):
+    _WORKER_STATE['counts'] = counts
+
+
+def _bootstrap_job(key: tuple, n_replicates: int, seed: np.random.SeedSequence) -> np.ndarray:
+    counts = _WORKER_STATE['counts'][key]
+    n_users = counts.shape[0]
+    # how often each user is drawn in each replicate: [replicates, users]
+    weights = np.random.default_rng(seed).multinomial(n_users, np.full(n_users, 1 / n_users), size=n_replicates)
+    return np.stack([krippendorff_alpha(counts, weights), fleiss_kappa(counts, weights)])
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Compute inter-rater reliability with bootstrap confidence intervals.')
+    parser.add_argument('ratings_file', type=Path, help='Collected ratings, e.g. data/rmh-stage2.csv')
+    parser.add_argument('--by', nargs='*', default=['task'], help='Columns to group by (default: task)')
+    parser.add_argument('--bootstrap', type=int, default=1000, help='Bootstrap replicates per group')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--leave-one-out', action='store_true', help='Also report the reliability without each user')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: #CPUs)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', type=Path, default=None, help='CSV file for the reliability per group')
+    parsed = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+    ratings = pd.read_csv(parsed.ratings_file, index_col=0)
+    result = reliability(ratings,
+                         by=parsed.by,
+                         n_bootstrap=parsed.bootstrap,
+                         confidence=parsed.confidence,
+                         n_workers=parsed.workers,
+                         seed=parsed.seed)
+    LOGGER.info(f'Reliability per {", ".join(parsed.by) if parsed.by else "rating"}:\n{result.round(3).to_string()}')
+    if parsed.output is not None:
+        result.to_csv(parsed.output)
+    if parsed.leave_one_out:
+        LOGGER.info(f'Reliability without each user:\n{leave_one_out(ratings).round(3).to_string()}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,416 @@
+"""Simulate raters to benchmark how fast different task-sampling strategies lead to a stable model ranking.
+
+Usage: `python -m rmh.simulate data/rmh-stage2.csv [--task overall] [--n-ratings 100000] [--policies uniform balanced]`
+
+Synthetic raters click the outcome of a task (a pair of models, optionally for a specific basin) with the empirical
+outcome probabilities of the collected ratings. A sampling policy decides which tasks the raters see, like
+`update_line_chart` on the website. After every batch of simulated ratings, we compare the ranking estimated from the
+simulated ratings with the ranking implied by the outcome probabilities (Kendall's tau and mean rank displacement).
+Many independent replicates run in parallel, vectorized along the replicate axis and spread over processes.
+"""
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+OUTCOME_COLUMNS = ['num_a_wins', 'num_b_wins', 'num_equal_good', 'num_equal_bad']
+A_WINS, B_WINS = 0, 1
+
+# a policy takes the random generator, the arms, the simulated outcome counts per replicate and arm (shape
+# [replicates, arms, outcomes]), and the number of tasks to draw. It returns arm indices of shape [replicates, n].
+Policy = Callable[[np.random.Generator, 'Arms', np.ndarray, int], np.ndarray]
+
+
+class Arms:
+    """Set of rating tasks that a sampling policy can choose from, with the outcome probabilities of each task.
+
+    Parameters
+    ----------
+    models : List[str]
+        Names of all models.
+    labels : pd.DataFrame
+        One row per arm with columns model_a and model_b, plus columns that describe the task (e.g., objective, basin).
+    probabilities : np.ndarray
+        Probabilities of the outcomes in `OUTCOME_COLUMNS` for each arm, shape [arms, 4].
+    weights : np.ndarray
+        Probability of each arm under the website's uniform sampling. The reference ranking is based on these weights.
+    """
+
+    def __init__(self, models: List[str], labels: pd.DataFrame, probabilities: np.ndarray, weights: np.ndarray):
+        self.models = list(models)
+        self.labels = labels.reset_index(drop=True)
+        self.probabilities = probabilities
+        self.weights = weights / weights.sum()
+        model_idx = {m: i for i, m in enumerate(self.models)}
+        self.model_a = self.labels['model_a'].map(model_idx).values
+        self.model_b = self.labels['model_b'].map(model_idx).values
+        # one-hot matrices that map per-arm counts to per-model counts, shape [arms, models]
+        self.is_a = np.eye(len(self.models))[self.model_a]
+        self.is_b = np.eye(len(self.models))[self.model_b]
+        self.cumulative = np.cumsum(probabilities, axis=1)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def reference_win_rate(self) -> np.ndarray:
+        """Win percentage of each model if every arm is rated infinitely often in proportion to its weight."""
+        return _win_rate(self.probabilities[..., A_WINS] * self.weights, self.probabilities[..., B_WINS] * self.weights,
+                         self)
+
+
+def load_ratings(ratings_file: Path, task: str) -> pd.DataFrame:
+    """Load the collected ratings of one task, e.g., `data/rmh-stage2.csv` and the task 'overall'."""
+    ratings = pd.read_csv(ratings_file, dtype={'basin': str})
+    ratings = ratings[ratings['task'] == task]
+    # for every rating, exactly one of the num_* columns is 1.
+    return ratings[ratings[OUTCOME_COLUMNS].sum(axis=1) == 1].reset_index(drop=True)
+
+
+def pair_arms(ratings: pd.DataFrame, prior: float = 2.0) -> Arms:
+    """Arms for every pair of models per objective, with the empirical outcome probabilities of each pair.
+
+    The website samples the objective, the basin, and the pair of models uniformly. Ignoring the basin, every pair of
+    an objective is therefore equally likely. Since the outcome counts of individual pairs are small, each pair's
+    probabilities are shrunk towards the outcome distribution of all pairs of the objective, with a Dirichlet prior of
+    strength `prior` (in ratings).
+
+    Parameters
+    ----------
+    ratings : pd.DataFrame
+        Ratings of one task as returned by `load_ratings`.
+    prior : float, optional
+        Strength of the prior in number of ratings.
+
+    Returns
+    -------
+    Arms
+        One arm per objective and unordered pair of models that occur in the ratings of the objective.
+    """
+    labels = []
+    for objective, objective_ratings in ratings.groupby('objective'):
+        models = sorted(set(objective_ratings['model_a']) | set(objective_ratings['model_b']))
+        n_pairs = len(models) * (len(models) - 1) // 2
+        labels += [{
+            'objective': objective,
+            'model_a': a,
+            'model_b': b,
+            'weight': 1 / n_pairs
+        } for i, a in enumerate(models) for b in models[i + 1:]]
+    labels = pd.DataFrame(labels)
+
+    arm_idx = {(o, a, b): i for i, (o, a, b) in enumerate(labels[['objective', 'model_a', 'model_b']].values)}
+    swapped = (ratings['model_a'] > ratings['model_b']).values
+    keys = zip(ratings['objective'], ratings[['model_a', 'model_b']].min(axis=1),
+               ratings[['model_a', 'model_b']].max(axis=1))
+    counts = _arm_counts(np.array([arm_idx[k] for k in keys]), _outcomes(ratings, swapped), len(labels))
+
+    probabilities = np.zeros((len(labels), len(OUTCOME_COLUMNS)))
+    for objective in labels['objective'].unique():
+        mask = (labels['objective'] == objective).values
+        probabilities[mask] = _shrink(counts[mask], prior)
+    return Arms(sorted(set(labels['model_a']) | set(labels['model_b'])), labels.drop(columns='weight'), probabilities,
+                labels['weight'].values)
+
+
+def metric_arms(ratings: pd.DataFrame, metrics: pd.DataFrame, metric: str, n_bins: int = 10,
+                prior: float = 2.0) -> Arms:
+    """Arms for every pair of models per objective and basin, with outcome probabilities conditioned on a metric.
+
+    We orient each pair such that model_a has the better (higher) metric and bin the absolute metric difference into
+    `n_bins` quantile bins. The outcome probabilities of an arm are the empirical probabilities of the ratings in its
+    bin, shrunk towards the outcome distribution of all ratings with a Dirichlet prior of strength `prior`.
+
+    Parameters
+    ----------
+    ratings : pd.DataFrame
+        Ratings of one task as returned by `load_ratings`.
+    metrics : pd.DataFrame
+        Metric values with columns objective, basin, model, and `metric`, e.g., exported from the notebooks.
+    metric : str
+        Name of the metric column. Higher values must be better (e.g., NSE, KGE).
+    n_bins : int, optional
+        Number of bins of the metric difference.
+    prior : float, optional
+        Strength of the prior in number of ratings.
+
+    Returns
+    -------
+    Arms
+        One arm per objective, basin, and unordered pair of models that have metric values.
+    """
+    metrics = metrics.dropna(subset=[metric]).astype({'basin': str})
+    pairs = metrics.merge(metrics, on=['objective', 'basin'], suffixes=('_a', '_b'))
+    # pairs with equal metrics are dropped, which also removes pairs of a model with itself
+    pairs = pairs[pairs[f'{metric}_a'] > pairs[f'{metric}_b']]
+    labels = pairs[['objective', 'basin', 'model_a', 'model_b']].reset_index(drop=True)
+    difference = (pairs[f'{metric}_a'] - pairs[f'{metric}_b']).values
+    # the website samples the objective uniformly, then the basin, then the pair
+    group_sizes = labels.groupby(['objective', 'basin'])['model_a'].transform('size').values
+    basins_per_objective = labels.groupby('objective')['basin'].transform('nunique').values
+    weights = 1 / (group_sizes * basins_per_objective)
+
+    values = metrics.set_index(['objective', 'basin', 'model'])[metric]
+    rated_a = values.reindex(pd.MultiIndex.from_arrays([ratings['objective'], ratings['basin'], ratings['model_a']]))
+    rated_b = values.reindex(pd.MultiIndex.from_arrays([ratings['objective'], ratings['basin'], ratings['model_b']]))
+    rated_difference = rated_a.values - rated_b.values
+    valid = ~np.isnan(rated_difference)
+    if valid.sum() < len(ratings):
+        LOGGER.warning(f'{len(ratings) - valid.sum()} ratings without {metric} values are ignored.')
+
+    edges = np.quantile(difference, np.linspace(0, 1, n_bins + 1)[1:-1])
+    counts = _arm_counts(np.digitize(np.abs(rated_difference[valid]), edges),
+                         _outcomes(ratings[valid], rated_difference[valid] < 0), n_bins)
+    bin_probabilities = _shrink(counts, prior)
+    return Arms(sorted(metrics['model'].unique()), labels, bin_probabilities[np.digitize(difference, edges)], weights)
+
+
+def uniform_policy(rng: np.random.Generator, arms: Arms, counts: np.ndarray, n: int) -> np.ndarray:
+    """Sample tasks like the website does: independently, with the arms' weights."""
+    return rng.choice(len(arms), size=(counts.shape[0], n), p=arms.weights)
+
+
+def balanced_policy(rng: np.random.Generator, arms: Arms, counts: np.ndarray, n: int) -> np.ndarray:
+    """Show the arms that are most underrated relative to their weight, breaking ties randomly."""
+    n_rated = counts.sum(axis=2).astype(float)
+    choices = []
+    for start in range(0, n, len(arms)):
+        deficit = (n_rated + rng.random(n_rated.shape)) / arms.weights
+        size = min(len(arms), n - start)
+        choice = np.argpartition(deficit, size - 1, axis=1)[:, :size]
+        np.put_along_axis(n_rated, choice, np.take_along_axis(n_rated, choice, axis=1) + 1, axis=1)
+        choices.append(choice)
+    return np.concatenate(choices, axis=1)
+
+
+def uncertainty_policy(rng: np.random.Generator, arms: Arms, counts: np.ndarray, n: int) -> np.ndarray:
+    """Sample arms in proportion to their weight and the posterior variance of the probability that model_a wins."""
+    alpha = counts[..., A_WINS] + 1.0
+    beta = counts[..., B_WINS] + 1.0
+    variance = alpha * beta / ((alpha + beta)**2 * (alpha + beta + 1))
+    cumulative = np.cumsum(variance * arms.weights, axis=1)
+    u = rng.random((counts.shape[0], n)) * cumulative[:, -1:]
+    return np.stack([np.searchsorted(cumulative[r], u[r], side='right') for r in range(counts.shape[0])])
+
+
+POLICIES: Dict[str, Policy] = {
+    'uniform': uniform_policy,
+    'balanced': balanced_policy,
+    'uncertainty': uncertainty_policy,
+}
+
+
+def simulate(arms: Arms, policy: Policy, n_ratings: int, n_replicates: int, report_every: int,
+             seed: np.random.SeedSequence) -> Dict[str, np.ndarray]:
+    """Simulate independent rating campaigns in one process.
+
+    The policy draws `report_every` tasks at a time for all replicates, so adaptive policies see the counts of all
+    previous batches.
+
+    Parameters
+    ----------
+    arms : Arms
+        Tasks and their outcome probabilities.
+    policy : Policy
+        Sampling policy, e.g., one of `POLICIES`. Must be picklable to be used with multiple processes.
+    n_ratings : int
+        Number of simulated ratings per replicate.
+    n_replicates : int
+        Number of independent replicates.
+    report_every : int
+        Number of ratings between two evaluations of the ranking.
+    seed : np.random.SeedSequence
+        Seed of the simulation.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        Number of ratings at each evaluation (shape [evaluations]), and Kendall's tau and mean absolute rank difference
+        between the estimated and reference ranking (shape [replicates, evaluations]).
+    """
+    rng = np.random.default_rng(seed)
+    reference = arms.reference_win_rate()
+    counts = np.zeros((n_replicates, len(arms), len(OUTCOME_COLUMNS)), dtype=np.int64)
+    replicate_offset = np.arange(n_replicates)[:, None] * counts[0].size
+
+    n_evaluated, tau, rank_error = [], [], []
+    for start in range(0, n_ratings, report_every):
+        n = min(report_every, n_ratings - start)
+        chosen = policy(rng, arms, counts, n)
+        # inverse-CDF sampling of the outcome of each chosen arm
+        outcome = (rng.random(chosen.shape)[..., None] > arms.cumulative[chosen][..., :-1]).sum(axis=-1)
+        flat_idx = replicate_offset + chosen * len(OUTCOME_COLUMNS) + outcome
+        counts += np.bincount(flat_idx.ravel(), minlength=counts.size).reshape(counts.shape)
+
+        estimate = _estimated_win_rate(counts, arms)
+        n_evaluated.append(start + n)
+        tau.append(kendall_tau(estimate, reference))
+        rank_error.append(np.abs(_ranks(estimate) - _ranks(reference)).mean(axis=-1))
+
+    return {'n_ratings': np.array(n_evaluated), 'tau': np.stack(tau, axis=1), 'rank_error': np.stack(rank_error, axis=1)}
+
+
+def run(arms: Arms,
+        policies: Dict[str, Policy],
+        n_ratings: int,
+        n_replicates: int,
+        report_every: int = 100,
+        n_workers: int = None,
+        seed: int = None) -> pd.DataFrame:
+    """Simulate rating campaigns for several policies, spread over multiple processes.
+
+    Parameters
+    ----------
+    arms : Arms
+        Tasks and their outcome probabilities.
+    policies : Dict[str, Policy]
+        Sampling policies by name.
+    n_ratings : int
+        Number of simulated ratings per replicate.
+    n_replicates : int
+        Number of independent replicates per policy.
+    report_every : int, optional
+        Number of ratings between two evaluations of the ranking.
+    n_workers : int, optional
+        Number of processes. Defaults to the number of CPUs.
+    seed : int, optional
+        Seed for reproducible simulations.
+
+    Returns
+    -------
+    pd.DataFrame
+        Ranking convergence per policy and number of ratings: mean and 5%/95% quantiles of Kendall's tau, and mean
+        absolute rank difference.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(policies))
+    n_workers = n_workers if n_workers is not None else os.cpu_count()
+    block_sizes = [len(block) for block in np.array_split(np.arange(n_replicates), n_workers) if len(block) > 0]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            name: [
+                executor.submit(simulate, arms, policy, n_ratings, size, report_every, block_seed)
+                for size, block_seed in zip(block_sizes, policy_seed.spawn(len(block_sizes)))
+            ] for (name, policy), policy_seed in zip(policies.items(), seeds)
+        }
+
+        reports = []
+        for name, policy_futures in futures.items():
+            results = [future.result() for future in policy_futures]
+            tau = np.concatenate([r['tau'] for r in results])
+            rank_error = np.concatenate([r['rank_error'] for r in results])
+            reports.append(
+                pd.DataFrame({
+                    'policy': name,
+                    'n_ratings': results[0]['n_ratings'],
+                    'tau_mean': tau.mean(axis=0),
+                    'tau_q05': np.quantile(tau, 0.05, axis=0),
+                    'tau_q95': np.quantile(tau, 0.95, axis=0),
+                    'rank_error_mean': rank_error.mean(axis=0),
+                }))
+    return pd.concat(reports, ignore_index=True)
+
+
+def ratings_needed(report: pd.DataFrame, threshold: float = 0.9) -> pd.Series:
+    """Number of ratings after which 95% of the replicates of each policy reach a Kendall's tau of `threshold`."""
+    converged = report[report['tau_q05'] >= threshold]
+    return converged.groupby('policy')['n_ratings'].min().reindex(report['policy'].unique())
+
+
+def kendall_tau(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Kendall's tau (tau-a) between the last axes of `x` and `y`, vectorized over all leading axes."""
+    n = x.shape[-1]
+    upper = np.triu_indices(n, k=1)
+    concordance = np.sign(x[..., :, None] - x[..., None, :]) * np.sign(y[..., :, None] - y[..., None, :])
+    return concordance[..., upper[0], upper[1]].sum(axis=-1) / (n * (n - 1) / 2)
+
+
+def _estimated_win_rate(counts: np.ndarray, arms: Arms) -> np.ndarray:
+    # estimate each arm's outcome probabilities (with a uniform prior, so unrated arms are neutral) and weight them
+    # like the reference. With uniform sampling this converges to the simple win percentage used in the paper, but it
+    # stays unbiased for policies that rate some arms more often than others.
+    probabilities = (counts + 1) / (counts.sum(axis=-1, keepdims=True) + len(OUTCOME_COLUMNS))
+    return _win_rate(probabilities[..., A_WINS] * arms.weights, probabilities[..., B_WINS] * arms.weights, arms)
+
+
+def _win_rate(a_wins: np.ndarray, b_wins: np.ndarray, arms: Arms) -> np.ndarray:
+    won = a_wins @ arms.is_a + b_wins @ arms.is_b
+    lost = b_wins @ arms.is_a + a_wins @ arms.is_b
+    with np.errstate(invalid='ignore'):
+        return 100 * won / (won + lost)
+
+
+def _ranks(values: np.ndarray) -> np.ndarray:
+    return np.argsort(np.argsort(values, axis=-1), axis=-1)
+
+
+def _outcomes(ratings: pd.DataFrame, swapped: np.ndarray) -> np.ndarray:
+    outcome = ratings[OUTCOME_COLUMNS].values.argmax(axis=1)
+    # if model_a and model_b are swapped with respect to the arm, so are their wins
+    swap = np.array([B_WINS, A_WINS, 2, 3])
+    return np.where(swapped, swap[outcome], outcome)
+
+
+def _arm_counts(arm_idx: np.ndarray, outcome: np.ndarray, n_arms: int) -> np.ndarray:
+    counts = np.bincount(arm_idx * len(OUTCOME_COLUMNS) + outcome, minlength=n_arms * len(OUTCOME_COLUMNS))
+    return counts.reshape(n_arms, len(OUTCOME_COLUMNS))
+
+
+def _shrink(counts: np.ndarray, prior: float) -> np.ndarray:
+    # outcome distribution of all arms, symmetric in model_a and model_b
+    base = counts.sum(axis=0).astype(float)
+    base[[A_WINS, B_WINS]] = base[[A_WINS, B_WINS]].mean()
+    base = (base + 1) / (base + 1).sum()
+    return (counts + prior * base) / (counts.sum(axis=1, keepdims=True) + prior)
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Simulate raters to compare task-sampling policies.')
+    parser.add_argument('ratings_file', type=Path, help='Collected ratings, e.g. data/rmh-stage2.csv')
+    parser.add_argument('--task', default='overall', choices=['overall', 'high-flow', 'low-flow'])
+    parser.add_argument('--policies', nargs='+', default=list(POLICIES.keys()), choices=list(POLICIES.keys()))
+    parser.add_argument('--n-ratings', type=int, default=10000, help='Simulated ratings per replicate')
+    parser.add_argument('--replicates', type=int, default=100, help='Replicates per policy')
+    parser.add_argument('--report-every', type=int, default=100, help='Ratings between ranking evaluations')
+    parser.add_argument('--prior', type=float, default=2.0, help='Strength of the prior on outcome probabilities')
+    parser.add_argument('--metrics', type=Path, default=None, help='CSV with columns objective, basin, model, <metric>')
+    parser.add_argument('--metric', default='NSE', help='Metric column to condition the outcome probabilities on')
+    parser.add_argument('--bins', type=int, default=10, help='Number of metric difference bins')
+    parser.add_argument('--threshold', type=float, default=0.9, help="Kendall's tau that counts as converged")
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: #CPUs)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', type=Path, default=None, help='CSV file for the convergence report')
+    parsed = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+    ratings = load_ratings(parsed.ratings_file, parsed.task)
+    if parsed.metrics is not None:
+        arms = metric_arms(ratings, pd.read_csv(parsed.metrics), parsed.metric, n_bins=parsed.bins, prior=parsed.prior)
+    else:
+        arms = pair_arms(ratings, prior=parsed.prior)
+    LOGGER.info(f'Simulating {len(parsed.policies)} policies on {len(arms)} arms from {len(ratings)} ratings.')
+
+    report = run(arms, {name: POLICIES[name] for name in parsed.policies},
+                 n_ratings=parsed.n_ratings,
+                 n_replicates=parsed.replicates,
+                 report_every=parsed.report_every,
+                 n_workers=parsed.workers,
+                 seed=parsed.seed)
+    if parsed.output is not None:
+        report.to_csv(parsed.output, index=False)
+    for name, n_needed in ratings_needed(report, parsed.threshold).items():
+        if np.isnan(n_needed):
+            LOGGER.info(f'{name}: tau >= {parsed.threshold} not reached within {parsed.n_ratings} ratings.')
+        else:
+            LOGGER.info(f'{name}: {int(n_needed)} ratings until tau >= {parsed.threshold} in 95% of the replicates.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""Model rankings stratified by basin attributes.
+
+`StratifiedRankings` joins the ratings to `data/static_attributes.csv` once, bins every attribute (quantiles or
+user-defined edges), and counts the outcomes of each (attribute, bin, task, model, opponent) cell in a single groupby.
+Afterwards, questions like "which models win in urban basins" are answered by indexing the count array instead of
+filtering the ratings again:
+
+    strata = StratifiedRankings(ratings, pd.read_csv('data/static_attributes.csv', dtype={'basin': str}))
+    strata.win_rates('Urban-and-Built-up', task='overall')
+    bradley_terry(*strata.pairwise_counts('area_km2', bin_idx=3))
+"""
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+OUTCOMES = ['won', 'lost', 'equal good', 'equal bad']
+TASKS = ['overall', 'high-flow', 'low-flow']
+
+
+class StratifiedRankings:
+    """Outcome counts per basin attribute bin, task, model, and opponent.
+
+    Parameters
+    ----------
+    ratings : pd.DataFrame
+        Ratings with columns basin, task, model_a, model_b, and num_a_wins, num_b_wins, num_equal_good, num_equal_bad.
+    attributes : pd.DataFrame
+        Basin attributes with a basin column and one column per attribute.
+    bins : Dict[str, Union[int, Sequence[float]]], optional
+        Number of quantile bins or bin edges per attribute. Attributes that are not listed use `n_quantiles` quantile
+        bins. Quantiles are computed across basins, not ratings, so each bin contains about the same number of basins.
+    n_quantiles : int, optional
+        Default number of quantile bins.
+    """
+
+    def __init__(self,
+                 ratings: pd.DataFrame,
+                 attributes: pd.DataFrame,
+                 bins: Dict[str, Union[int, Sequence[float]]] = None,
+                 n_quantiles: int = 4):
+        bins = bins if bins is not None else {}
+        attributes = attributes.astype({'basin': str}).set_index('basin')
+        self.attributes = list(attributes.columns)
+        self.models = sorted(set(ratings['model_a']) | set(ratings['model_b']))
+        self.tasks = [t for t in TASKS if t in set(ratings['task'])]
+
+        # bin codes of each basin and attribute, -1 for missing values
+        self.bin_edges = {}
+        codes = {}
+        for attribute in self.attributes:
+            attribute_bins = bins.get(attribute, n_quantiles)
+            if np.isscalar(attribute_bins):
+                binned, edges = pd.qcut(attributes[attribute], attribute_bins, retbins=True, duplicates='drop')
+            else:
+                binned, edges = pd.cut(attributes[attribute], attribute_bins, retbins=True, include_lowest=True)
+            codes[attribute] = binned.cat.codes
+            self.bin_edges[attribute] = edges
+        codes = pd.DataFrame(codes)
+        self.n_bins = max(len(edges) - 1 for edges in self.bin_edges.values())
+
+        # each rating counts once from the perspective of model_a and once from the perspective of model_b
+        model_idx = {m: i for i, m in enumerate(self.models)}
+        task_idx = {t: i for i, t in enumerate(self.tasks)}
+        ratings = ratings[ratings['task'].isin(self.tasks) & ratings['basin'].astype(str).isin(codes.index)]
+        a_outcomes = ratings[['num_a_wins', 'num_b_wins', 'num_equal_good', 'num_equal_bad']].values
+        perspectives = pd.DataFrame({
+            'basin': np.tile(ratings['basin'].astype(str).values, 2),
+            'task': np.tile(ratings['task'].map(task_idx).values, 2),
+            'model': np.concatenate([ratings['model_a'].map(model_idx), ratings['model_b'].map(model_idx)]),
+            'opponent': np.concatenate([ratings['model_b'].map(model_idx), ratings['model_a'].map(model_idx)]),
+        })
+        outcomes = pd.DataFrame(np.concatenate([a_outcomes, a_outcomes[:, [1, 0, 2, 3]]]), columns=OUTCOMES)
+
+        # long format with one row per rating perspective and attribute, then one groupby over all cells
+        attribute_codes = codes.loc[perspectives['basin']].values  # [perspectives, attributes]
+        n_attributes = len(self.attributes)
+        long = pd.DataFrame({
+            'attribute': np.tile(np.arange(n_attributes), len(perspectives)),
+            'bin': attribute_codes.ravel(),
+            'task': np.repeat(perspectives['task'].values, n_attributes),
+            'model': np.repeat(perspectives['model'].values, n_attributes),
+            'opponent': np.repeat(perspectives['opponent'].values, n_attributes),
+        })
+        long[OUTCOMES] = np.repeat(outcomes.values, n_attributes, axis=0)
+        long = long[long['bin'] >= 0]
+        cells = long.groupby(['attribute', 'bin', 'task', 'model', 'opponent'])[OUTCOMES].sum()
+
+        shape = (n_attributes, self.n_bins, len(self.tasks), len(self.models), len(self.models))
+        self.counts = np.zeros(shape + (len(OUTCOMES),), dtype=np.int64)
+        self.counts[tuple(cells.index.get_level_values(i).values for i in range(len(shape)))] = cells.values
+
+    def _select(self, attribute: str, bin_idx: int = None, task: str = None) -> np.ndarray:
+        counts = self.counts[self.attributes.index(attribute)]
+        counts = counts[[bin_idx]] if bin_idx is not None else counts
+        counts = counts[:, [self.tasks.index(task)]] if task is not None else counts
+        return counts
+
+    def bin_labels(self, attribute: str) -> List[str]:
+        edges = self.bin_edges[attribute]
+        return [f'{lower:.3g}–{upper:.3g}' for lower, upper in zip(edges[:-1], edges[1:])]
+
+    def win_rates(self, attribute: str, task: str = None) -> pd.DataFrame:
+        """Win percentage of each model (rows) in each bin of an attribute (columns), as in the notebooks' `rank`.
+
+        Parameters
+        ----------
+        attribute : str
+            Name of the basin attribute.
+        task : str, optional
+            Rating task. If None, all tasks are combined.
+
+        Returns
+        -------
+        pd.DataFrame
+            100 * won / (won + lost) per model and bin. NaN if a model has no decided ratings in a bin.
+        """
+        counts = self._select(attribute, task=task).sum(axis=(1, 3))  # [bins, models, outcomes]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            win_rate = 100 * counts[..., 0] / (counts[..., 0] + counts[..., 1])
+        n_bins = len(self.bin_edges[attribute]) - 1
+        return pd.DataFrame(win_rate[:n_bins].T, index=self.models, columns=self.bin_labels(attribute))
+
+    def summary(self, attribute: str, bin_idx: int, task: str = None) -> pd.DataFrame:
+        """Wins, losses, equal ratings, and win percentage of each model in one bin of an attribute."""
+        counts = self._select(attribute, bin_idx, task).sum(axis=(0, 1, 3))  # [models, outcomes]
+        stats = pd.DataFrame(counts, index=self.models, columns=OUTCOMES)
+        stats['number of ratings'] = stats[OUTCOMES].sum(axis=1)
+        stats['win%'] = 100 * stats['won'] / (stats['won'] + stats['lost'])
+        return stats.sort_values(by='win%')
+
+    def pairwise_counts(self, attribute: str, bin_idx: int = None, task: str = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Bradley–Terry input of one attribute bin: wins[i, j] is how often model i beat model j, and ties[i, j] how
+        often they were rated equal (good or bad). Both are indexed like `models`."""
+        counts = self._select(attribute, bin_idx, task).sum(axis=(0, 1))  # [models, opponents, outcomes]
+        return counts[..., 0], counts[..., 2] + counts[..., 3]
+
+
+def bradley_terry(wins: np.ndarray, ties: np.ndarray = None, n_iter: int = 1000, tol: float = 1e-8) -> np.ndarray:
+    """Bradley–Terry strengths from a pairwise win matrix with the MM algorithm of Hunter (2004).
+
+    Ties count as half a win for each model. Models without any comparison get NaN.
+
+    Parameters
+    ----------
+    wins : np.ndarray
+        wins[i, j] is the number of times model i beat model j.
+    ties : np.ndarray, optional
+        Symmetric number of ties between models i and j.
+    n_iter : int, optional
+        Maximum number of iterations.
+    tol : float, optional
+        Convergence tolerance on the strengths.
+
+    Returns
+    -------
+    np.ndarray
+        Log-strength of each model, centered to mean zero.
+    """
+    wins = wins.astype(float)
+    if ties is not None:
+        wins = wins + ties / 2
+    comparisons = wins + wins.T
+    total_wins = wins.sum(axis=1)
+    compared = comparisons.sum(axis=1) > 0
+
+    strength = np.where(compared, 1.0, np.nan)
+    for _ in range(n_iter):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            denominator = np.nansum(comparisons / (strength[:, None] + strength[None, :]), axis=1)
+            updated = np.where(compared, total_wins / denominator, np.nan)
+        # models that never won would go to zero strength; keep them slightly positive so the log is finite
+        updated = np.where(compared, np.maximum(updated, 1e-10), np.nan)
+        updated /= np.nanmean(updated)
+        converged = np.nanmax(np.abs(updated - strength)) < tol
+        strength = updated
+        if converged:
+            break
+    log_strength = np.log(strength)
+    return log_strength - np.nanmean(log_strength)
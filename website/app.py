@@ -11,6 +11,9 @@ from flask_sqlalchemy import SQLAlchemy
 
 LOGGER = logging.getLogger(__name__)
 
+# the website shares code with the analyses, e.g., the hydrograph loader, through the rmh package in the repository root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
 load_dotenv()  # load environment variables from .env
 SALT = os.environ.get("SALT")
 db_connector = os.environ.get("DB_CONNECTOR", "postgresql")
@@ -18,6 +21,12 @@ db_name = os.environ.get("DB_NAME", "ratemyhydrograph")
 db_user = os.environ.get("DB_USER")
 db_pwd = os.environ.get("DB_PASSWORD")
 log_file = os.environ.get("LOG_FILE", "ratemyhydrograph.log")
+ADMIN_KEY = os.environ.get("ADMIN_KEY")  # optional, enables the /results page
+CHUNK_DIR = os.environ.get("CHUNK_DIR", "chunks")  # directory for the precomputed hydrograph chunks
+# optional sampling profiler of the server callbacks, can also be changed at runtime via /_profiler?key=<ADMIN_KEY>
+PROFILE_FRACTION = float(os.environ.get("PROFILE_FRACTION", 0))  # fraction of callback requests to profile
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0))  # profile callbacks slower than this, 0: off
+DB_POOL_SIZE = os.environ.get("DB_POOL_SIZE")  # optional, database connections per worker (default of SQLAlchemy: 5)
 if db_user is None or db_pwd is None or SALT is None:
     raise ValueError('Database user/password or salt missing. Check .env file.')
 
@@ -65,6 +74,36 @@ app.title = 'Rate My Hydrograph'
 server.config["SQLALCHEMY_DATABASE_URI"] = f"{db_connector}://{db_user}:{db_pwd}@localhost/{db_name}"
 server.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 server.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 300, 'pool_pre_ping': True}
+if DB_POOL_SIZE is not None:
+    server.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'] = int(DB_POOL_SIZE)
+
+
+def make_db_cooperative(connector: str):
+    """Let database calls yield to other requests when the app runs on uwsgi's gevent loop (see uwsgi-gevent.ini).
+
+    gevent's monkey patching makes pure-Python drivers (e.g., pymysql) cooperative, but psycopg2 talks to the server
+    from C and would block all requests of the worker while it waits for Postgres.
+
+    Parameters
+    ----------
+    connector : str
+        SQLAlchemy dialect of the database URI.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return
+    if not monkey.is_module_patched('socket'):
+        return  # regular threaded workers
+    if connector.startswith('postgresql'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        LOGGER.info('Patched psycopg2 for gevent.')
+    elif 'pymysql' not in connector:
+        LOGGER.warning(f'Database driver of {connector} may block the gevent loop. Use mysql+pymysql or postgresql.')
+
+
+make_db_cooperative(db_connector)
 db = SQLAlchemy(server)
 
 
@@ -1,21 +1,16 @@
-from dash import Input, Output, State
+from dash import ClientsideFunction, Input, Output, State
 
 from app import app
 from database import User
 
 
-@app.callback(Output("leaderboard_modal", "is_open"), Input("leaderboard_open", "n_clicks"),
-              Input("leaderboard_close", "n_clicks"), State("leaderboard_modal", "is_open"))
-def toggle_leaderboard(n1, n2, is_open):
-    if n1 or n2:
-        return not is_open
-    return is_open
+app.clientside_callback(ClientsideFunction(namespace='rmh', function_name='toggle_modal'),
+                        Output("leaderboard_modal", "is_open"), Input("leaderboard_open", "n_clicks"),
+                        Input("leaderboard_close", "n_clicks"), State("leaderboard_modal", "is_open"))
 
-
-@app.callback(Output("leaderboard_div", "hidden"), Input("state-user", "data"))
-def hide_leaderboard_button(user_id):
-    # only show leaderboard button if we know the user
-    return user_id is None or user_id == ''
+# only show leaderboard button if we know the user
+app.clientside_callback(ClientsideFunction(namespace='rmh', function_name='hide_without_user'),
+                        Output("leaderboard_div", "hidden"), Input("state-user", "data"))
 
 
 @app.callback(Output("leaderboard_text", "children"), Output("leaderboard_bar", "value"),
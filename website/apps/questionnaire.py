@@ -2,7 +2,7 @@ import logging
 from typing import List, Tuple, Union
 
 import dash_bootstrap_components as dbc
-from dash import Input, Output, State, dcc, html
+from dash import ClientsideFunction, Input, Output, State, dcc, html
 from sqlalchemy import exc
 
 from app import app, db
@@ -122,14 +122,11 @@ questionnaire_page = dbc.Card(
     ]))
 
 
-@app.callback(
-    Output("focus-freetext-div", "hidden"),
-    Input("checklist-focus", "value"),
-)
-def hide_focus_freetext(focus_areas: List[str]):
-    return focus_areas is None or 'other' not in focus_areas
+app.clientside_callback(ClientsideFunction(namespace='rmh', function_name='hide_focus_freetext'),
+                        Output("focus-freetext-div", "hidden"), Input("checklist-focus", "value"))
 
 
+# validation stays on the server, since submit_questionnaire needs to run the same checks anyway
 @app.callback(
     Output("submit-questionnaire", "disabled"),
     Input("radio-occupation", "value"),
@@ -1,21 +1,25 @@
-import hashlib
 import logging
 import time
 from pathlib import Path
+from typing import Optional, Tuple
 
 import dash_bootstrap_components as dbc
-import numpy as np
 import pandas as pd
-import plotly.graph_objs as go
-import xarray
 import dash
-from dash import Input, Output, State, dcc, html
+from dash import ClientsideFunction, Input, Output, State, dcc, html
 from sqlalchemy import exc
 
-from app import SALT, app, db
+from app import CHUNK_DIR, app, db
+from chunks import OBS_SERIES_ID, PYRAMID_BUCKETS, chunk_url, write_chunks
 from database import Rating, User
+from outcomes import OutcomeCube
+from rmh.ingest import load_data
+from task_token import model_id, sign_task, verify_task
+from worker import on_worker_start, rng
 
 N_YEARS = 1
+# longer windows are plotted from downsampled data, until the user zooms in (see chunks.write_chunks)
+MAX_POINTS_PER_TRACE = 1000
 
 OBS_COLOR = 'black'
 MODEL_ONE_COLOR = 'orange'
@@ -28,50 +32,33 @@ DATE_VAR_NAME = "time"
 LOGGER = logging.getLogger(__name__)
 
 
-def load_data(base_dir: Path) -> xarray.Dataset:
-    obs_file = base_dir / 'all_gauges.nc'
-    if not obs_file.exists():
-        raise ValueError(f'Observations netCDF file not found at {obs_file}')
-    # netcdfs only have a numeric dimension "nstations" that maps to the station_id variable.
-    # for easier processing, we directly make the station_id the dimension.
-    obs = xarray.load_dataset(obs_file).swap_dims({'nstations': BASIN_VAR_NAME})
-
-    # load hydrographs from individual models
-    hydrographs = {Q_VAR_NAME: obs[Q_VAR_NAME]}
-    model_dirs = [d for d in base_dir.glob('model/*') if d.is_dir()]
-    for model_dir in model_dirs:
-        model_name = model_dir.name
-        model_nc = list(model_dir.glob('*.nc'))
-        if len(model_nc) != 1:
-            LOGGER.info(f'Found {len(model_nc)} files for model {model_name}')
-            if len(model_nc) == 0:
-                continue
-        hydrographs[model_name] = xarray.open_dataset(model_nc[0]).swap_dims({'nstations': BASIN_VAR_NAME})[Q_VAR_NAME]
-
-    hydrograph_xr = xarray.concat(hydrographs.values(), dim='model')
-    hydrograph_xr['model'] = list(hydrographs.keys())
-    return hydrograph_xr
-
-
 OBJECTIVES = ['objective_2/great-lakes/validation-temporal', 'objective_1/great-lakes/validation-temporal']
 XR = {}
 YEARS = {}
 BASINS = {}
 AVAILABLE_MODELS = {}
+CHUNKS = {}
+PYRAMIDS = {}
 for obj in OBJECTIVES:
     XR[obj] = load_data(Path(f'../../data/{obj.split("/")[0]}'))
     YEARS[obj] = sorted(set(x.year for x in pd.date_range("2011", "2017", freq="Y")))
     BASINS[obj] = list(XR[obj][BASIN_VAR_NAME].values)
     AVAILABLE_MODELS[obj] = list(name for name in XR[obj]['model'].values if name != Q_VAR_NAME)
+    # the plotted hydrographs are served as static, cacheable files (see chunks.py)
+    CHUNKS[obj], PYRAMIDS[obj] = write_chunks(XR[obj], Q_VAR_NAME, AVAILABLE_MODELS[obj], YEARS[obj],
+                                              BASIN_VAR_NAME, DATE_VAR_NAME, Path(CHUNK_DIR))
     LOGGER.info(f'Using years {YEARS[obj][0]}-{YEARS[obj][-1]} from {len(BASINS[obj])} basins and '
                 f'{len(AVAILABLE_MODELS[obj])} models for objective {obj}')
 
 
-def hash_model_name(model_name: str) -> str:
-    return hashlib.sha512(f"{SALT}{model_name}".encode("utf-8")).hexdigest()
-
+MODEL_IDS = {model_id(m): m for obj in OBJECTIVES for m in AVAILABLE_MODELS[obj]}
 
-MODEL_HASHES = {hash_model_name(m): m for obj in OBJECTIVES for m in AVAILABLE_MODELS[obj]}
+# live outcome counts for the results page. Each worker keeps its own cube.
+OUTCOME_CUBE = OutcomeCube(models=sorted(set(m for obj in OBJECTIVES for m in AVAILABLE_MODELS[obj])),
+                           objectives=OBJECTIVES)
+# the cube is seeded before uwsgi forks the workers (see index.py). Each worker catches up with ratings from the time
+# between seeding and its start, e.g., after a reload.
+on_worker_start(OUTCOME_CUBE.refresh)
 
 rating_div_winner = html.Div(id="rating-div-winner",
                              children=[
@@ -107,6 +94,8 @@ rating_div_winner = html.Div(id="rating-div-winner",
 
 rating_page = dbc.Card([
     dcc.Graph(id="line-chart", style={}),
+    # hidden button that is clicked from assets/clientside.js once the hydrograph chunks of the current task are loaded
+    html.Button(id='chunks-loaded', n_clicks=0, hidden=True),
     html.Center([
         html.Div([
             # describes whether to rate high flows, low flows, or overall
@@ -139,27 +128,33 @@ rating_page = dbc.Card([
         centered=True,
     ),
     html.Div(id='location-dummy-rate'),
-    dcc.Store(id='state-basin'),
-    dcc.Store(id='state-objective'),
-    dcc.Store(id='state-start_date'),
-    dcc.Store(id='state-end_date'),
-    dcc.Store(id='state-model_a'),
-    dcc.Store(id='state-model_b'),
+    # signed token that describes the current task (objective, basin, year, models), see _encode_task.
+    dcc.Store(id='state-task'),
+    # URLs of the hydrograph chunks and ids of the series that are plotted by the clientside callback.
+    dcc.Store(id='state-plot'),
+    # axis ranges and y scale of the current plot. Filled client-side from the figure, so we don't have to send the
+    # whole figure to the server with every rating.
+    dcc.Store(id='state-axes'),
     # we'll use the counter's modified_time to track how long users take to rate each example.
     # we can't use the modified_time of the other states, because they don't always get modified every time
     # (two subsequent samples might have the same basin/models/etc.)
     dcc.Store(id='state-counter', data=-1),
 ])
 
+# summarize the current zoom level and y scale of the plot in the browser (see assets/clientside.js)
+app.clientside_callback(ClientsideFunction(namespace='rmh', function_name='axes_state'), Output('state-axes', 'data'),
+                        Input('line-chart', 'relayoutData'), Input('line-chart', 'figure'))
+
+# fetch the (browser-cached) hydrograph chunks of the current task and assemble the figure. When the user zooms in on a
+# long window, this fetches the full-resolution data of the visible years.
+app.clientside_callback(ClientsideFunction(namespace='rmh', function_name='hydrograph_figure'),
+                        Output('line-chart', 'figure'), Input('state-plot', 'data'), Input('chunks-loaded', 'n_clicks'),
+                        Input('line-chart', 'relayoutData'), State('line-chart', 'figure'))
+
 
 @app.callback(
-    Output("line-chart", "figure"),
-    Output("state-basin", "data"),
-    Output("state-objective", "data"),
-    Output("state-start_date", "data"),
-    Output("state-end_date", "data"),
-    Output("state-model_a", "data"),
-    Output("state-model_b", "data"),
+    Output("state-plot", "data"),
+    Output("state-task", "data"),
     Output("state-counter", "data"),
     Output("task-description", "children"),
     Output("rating-progress", "value"),
@@ -176,55 +171,44 @@ rating_page = dbc.Card([
     # variable populated already during the initial page load
     Input("state-user", "modified_timestamp"),
     State("state-user", "data"),
-    State("state-basin", "data"),
-    State("state-objective", "data"),
-    State("state-start_date", "data"),
-    State("state-end_date", "data"),
-    State("state-model_a", "data"),
-    State("state-model_b", "data"),
-    State("line-chart", "figure"),
+    State("state-task", "data"),
+    State("state-axes", "data"),
     # state gets updated with every rating, so the time since model_b was last modified tells us how long the user
     # took to rate the current example.
     State("state-counter", "data"),
     State("state-counter", "modified_timestamp"))
 def update_line_chart(model_one_click: int, model_two_click: int, equal_good_click: int, equal_bad_click: int,
-                      user_timestamp: int, user_id: str, basin: str, objective: str, start_date: str, end_date: str,
-                      model_a_hash: str, model_b_hash: str, figure, counter_state: int, rating_start_time: int):
-
-    # set a random seed, so that multiple workers (that are all forked from each other) don't have the same randomness
-    # and therefore show the same tasks. It'd suffice to do this once per worker, but it's cheap and we'd need a global
-    # variable to determine the first call, so we do it on every call.
-    np.random.seed(int(time.time() * 1000) % (2**32))
+                      user_timestamp: int, user_id: str, task_token: str, axes: dict, counter_state: int,
+                      rating_start_time: int):
 
     if user_id is None or user_id == '':
-        return None, None, None, None, None, None, None, counter_state, '', 0, '', '', '', False, '/questionnaire'
+        return None, None, counter_state, '', 0, '', '', '', False, '/questionnaire'
     user = User.query.filter_by(id=user_id).first()
     if user is None:
-        return None, None, None, None, None, None, None, counter_state, '', 0, '', '', '', False, '/questionnaire'
+        return None, None, counter_state, '', 0, '', '', '', False, '/questionnaire'
 
     y_scale = 'linear'
     task = None
 
     # Catch initial page loading, where no plot has been shown yet
-    if basin is not None:
-
+    rated_task = _decode_task(task_token) if task_token is not None else None
+    if rated_task is not None:
+        objective, basin, start_date, end_date, model_a, model_b = rated_task
         rating_duration = int(time.time() * 1000) - rating_start_time
 
         # figure out if the user submitted their rating while looking at a log-scale or linear-scale axis
-        if figure is not None:
-            x_range = figure.get("layout", {}).get("xaxis", {}).get("range", [start_date, end_date])
-            y_range = figure.get("layout", {}).get("yaxis", {}).get("range", [-999, -999])
-            try:
-                x_zoomed = any(
-                    pd.to_datetime(x1) != pd.to_datetime(x2) for x1, x2 in zip(x_range, [start_date, end_date]))
-            except Exception as exception:
-                # just to be sure we don't crash if someone injects a non-date value
-                LOGGER.warning(f'Invalid x range or start/end date: {x_range}, {[start_date, end_date]}')
-                x_zoomed = False
-            y_zoomed = not figure.get("layout", {}).get("yaxis", {}).get("autorange", True)
-            y_scale = figure.get("layout", {}).get("yaxis", {}).get("type", 'linear')
-
-        model_a, model_b = MODEL_HASHES[model_a_hash], MODEL_HASHES[model_b_hash]
+        axes = axes if isinstance(axes, dict) else {}
+        x_range = axes.get("x_range", [start_date.isoformat(), end_date.isoformat()])
+        y_range = axes.get("y_range", [-999, -999])
+        try:
+            x_zoomed = any(pd.to_datetime(x1) != pd.to_datetime(x2) for x1, x2 in zip(x_range, [start_date, end_date]))
+        except Exception as exception:
+            # just to be sure we don't crash if someone injects a non-date value
+            LOGGER.warning(f'Invalid x range or start/end date: {x_range}, {[start_date, end_date]}')
+            x_zoomed = False
+        y_zoomed = not axes.get("y_autorange", True)
+        y_scale = axes.get("y_scale") if axes.get("y_scale") in ['linear', 'log'] else 'linear'
+
         task = _get_task(counter_state)  # get task type for current counter (before incrementing)
         ratings = Rating(user_id=user_id,
                          objective=objective,
@@ -263,76 +247,26 @@ def update_line_chart(model_one_click: int, model_two_click: int, equal_good_cli
             db.session.add(user)
             db.session.add(ratings)
             db.session.commit()
+            OUTCOME_CUBE.record(ratings)
         except exc.SQLAlchemyError as exception:
             LOGGER.error(f'Rating could not be committed: {exception}')
 
     # sample basin, time slice and models
-    obj = np.random.choice(OBJECTIVES)
-    basin = np.random.choice(BASINS[obj])
-    year = np.random.choice(YEARS[obj][:-N_YEARS])
-    start_date = pd.to_datetime(f"01-01-{year}", format="%d-%m-%Y")
-    end_date = pd.to_datetime(f"31-12-{year+N_YEARS}", format="%d-%m-%Y")
-    plot_models = [Q_VAR_NAME] + list(np.random.choice(AVAILABLE_MODELS[obj], 2, replace=False))
-    df = XR[obj].sel({
-        'model': plot_models,
-        BASIN_VAR_NAME: basin,
-        DATE_VAR_NAME: slice(start_date, end_date)
-    }).to_dataframe().drop(BASIN_VAR_NAME, axis=1)
-
-    # create line objects
-    index = df.loc[Q_VAR_NAME].index
-    data = [
-        go.Scatter(y=df.loc[Q_VAR_NAME, Q_VAR_NAME],
-                   x=index,
-                   name="Q obs.",
-                   line=dict(color=OBS_COLOR, dash='dot'),
-                   yaxis='y'),
-        go.Scatter(y=df.loc[plot_models[1], Q_VAR_NAME],
-                   x=index,
-                   name="Model 1",
-                   line=dict(color=MODEL_ONE_COLOR),
-                   yaxis='y'),
-        go.Scatter(y=df.loc[plot_models[2], Q_VAR_NAME],
-                   x=index,
-                   name="Model 2",
-                   line=dict(color=MODEL_TWO_COLOR),
-                   yaxis='y')
-    ]
-
-    # define layout
-    layout = go.Layout(xaxis={
-        'type': 'date',
-        'title': "Date",
-        'range': [index[0], index[-1]],
-        'titlefont': {
-            'size': 16
-        }
-    },
-                       yaxis={
-                           'type': y_scale,
-                           'title': "Discharge (m³/s)",
-                           'range': [0, df.max() * 1.3],
-                           'titlefont': {
-                               'size': 16
-                           }
-                       },
-                       updatemenus=[
-                           dict(type="buttons",
-                                direction="right",
-                                xanchor="left",
-                                yanchor="bottom",
-                                y=1,
-                                x=0,
-                                active=0 if y_scale == 'linear' else 1,
-                                buttons=list([
-                                    dict(args=[{
-                                        'yaxis.type': 'linear'
-                                    }], label="Linear scale", method="relayout"),
-                                    dict(args=[{
-                                        'yaxis.type': 'log'
-                                    }], label="Log scale", method="relayout")
-                                ])),
-                       ])
+    # each worker thread has its own generator, so forked workers don't show the same tasks (see worker.py)
+    random = rng()
+    obj = random.choice(OBJECTIVES)
+    basin = random.choice(BASINS[obj])
+    year = int(random.choice(YEARS[obj][:-N_YEARS]))
+    plot_models = list(random.choice(AVAILABLE_MODELS[obj], 2, replace=False))
+    plot = {
+        'window': [f'{year}-01-01', f'{year + N_YEARS}-12-31'],
+        'chunks': [[y, chunk_url(CHUNKS[obj][(basin, y)])] for y in range(year, year + N_YEARS + 1)],
+        'pyramid': [[bucket, chunk_url(PYRAMIDS[obj][(basin, bucket)])] for bucket in PYRAMID_BUCKETS],
+        'max_points': MAX_POINTS_PER_TRACE,
+        'series': [OBS_SERIES_ID, model_id(plot_models[0]), model_id(plot_models[1])],
+        'colors': [OBS_COLOR, MODEL_ONE_COLOR, MODEL_TWO_COLOR],
+        'y_scale': y_scale,
+    }
 
     new_task = _get_task(counter_state + 1)
     task_description = [html.H6('Which hydrograph is better in terms of ', style={'display': 'inline'})] \
@@ -353,10 +287,28 @@ def update_line_chart(model_one_click: int, model_two_click: int, equal_good_cli
     progress_message = f'{n_recommended - user.n_rated_hydrographs} more hydrographs' if rating_progress < 100 \
         else 'Keep rating as many hydrographs as you like!'
 
-    # use hashing so the user can't use browser dev tools to figure out the model names
-    return dict(data=data, layout=layout), basin, obj, start_date, end_date, \
-        hash_model_name(plot_models[1]), hash_model_name(plot_models[2]), \
-            counter_state + 1, task_description, rating_progress, progress_message, '', task_message, task_message != [], None
+    new_task_token = _encode_task(obj, basin, year, plot_models[0], plot_models[1])
+    return plot, new_task_token, counter_state + 1, task_description, rating_progress, \
+        progress_message, '', task_message, task_message != [], None
+
+
+def _encode_task(objective: str, basin: str, year: int, model_a: str, model_b: str) -> str:
+    # use keyed model ids so the user can't use browser dev tools to figure out the model names
+    return sign_task([OBJECTIVES.index(objective), basin, int(year), model_id(model_a), model_id(model_b)])
+
+
+def _decode_task(task_token: str) -> Optional[Tuple[str, str, pd.Timestamp, pd.Timestamp, str, str]]:
+    task = verify_task(task_token)
+    try:
+        obj_idx, basin, year, model_a_id, model_b_id = task
+        objective = OBJECTIVES[obj_idx]
+        model_a, model_b = MODEL_IDS[model_a_id], MODEL_IDS[model_b_id]
+    except (TypeError, ValueError, IndexError, KeyError):
+        LOGGER.warning(f'Ignoring rating for invalid task token {task_token}')
+        return None
+    start_date = pd.to_datetime(f"01-01-{year}", format="%d-%m-%Y")
+    end_date = pd.to_datetime(f"31-12-{year+N_YEARS}", format="%d-%m-%Y")
+    return objective, basin, start_date, end_date, model_a, model_b
 
 
 def _get_task(counter: int) -> str:
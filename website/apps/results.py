@@ -0,0 +1,84 @@
+import hmac
+from urllib.parse import parse_qs
+
+import dash_bootstrap_components as dbc
+import pandas as pd
+from dash import Input, Output, State, dcc, html
+
+from app import ADMIN_KEY, app
+from apps.rate import OBJECTIVES, OUTCOME_CUBE
+from outcomes import TASKS
+
+ALL = 'all'
+REFRESH_INTERVAL_MS = 10 * 1000
+
+results_page = dbc.Card(
+    dbc.CardBody([
+        html.H4('Current results', className='card-title'),
+        html.P(id='results-summary'),
+        dbc.Row([
+            dbc.Col([
+                dbc.Label('Task', html_for='results-task'),
+                dbc.Select(id='results-task',
+                           options=[{
+                               'label': 'All combined',
+                               'value': ALL
+                           }] + [{
+                               'label': t,
+                               'value': t
+                           } for t in TASKS],
+                           value=ALL),
+            ]),
+            dbc.Col([
+                dbc.Label('Objective', html_for='results-objective'),
+                dbc.Select(id='results-objective',
+                           options=[{
+                               'label': 'All combined',
+                               'value': ALL
+                           }] + [{
+                               'label': o.split('/')[0],
+                               'value': o
+                           } for o in OBJECTIVES],
+                           value=ALL),
+            ]),
+        ],
+                className='mb-3'),
+        html.H5('Model ranking'),
+        html.Div(id='results-ranking', className='mb-3'),
+        html.H5('Pairwise win% (row model vs. column model)'),
+        html.Div(id='results-pairwise', style={'overflowX': 'auto'}),
+        dcc.Interval(id='results-interval', interval=REFRESH_INTERVAL_MS),
+    ]))
+
+
+@app.callback(Output('results-summary', 'children'), Output('results-ranking', 'children'),
+              Output('results-pairwise', 'children'), Input('results-task', 'value'),
+              Input('results-objective', 'value'), Input('results-interval', 'n_intervals'), State('url', 'search'))
+def update_results(task: str, objective: str, n_intervals: int, search: str):
+    if not is_admin(search):
+        return '', [], []
+    # pick up the ratings that other workers have written. The cube queries the database at most every few seconds,
+    # no matter how many results pages are open.
+    OUTCOME_CUBE.refresh()
+    task = None if task == ALL else task
+    objective = None if objective == ALL else objective
+
+    ranking = OUTCOME_CUBE.rank(task, objective).reset_index()
+    pairwise = OUTCOME_CUBE.pairwise(task, objective)
+    pairwise = pairwise.loc[ranking['model'], ranking['model']]
+    pairwise.index.name = 'model'
+
+    summary = f'{OUTCOME_CUBE.n_ratings()} ratings in total.'
+    return summary, _table(ranking), _table(pairwise.reset_index(), precision=0)
+
+
+def is_admin(search: str) -> bool:
+    # the results page is only available if an admin key is configured and passed as ?key=<ADMIN_KEY>
+    if not ADMIN_KEY or not search:
+        return False
+    key = parse_qs(search.lstrip('?')).get('key', [''])[0]
+    return hmac.compare_digest(key.encode('utf-8'), ADMIN_KEY.encode('utf-8'))
+
+
+def _table(df: pd.DataFrame, precision: int = 2) -> dbc.Table:
+    return dbc.Table.from_dataframe(df.round(precision).fillna(''), striped=True, bordered=True, hover=True, size='sm')
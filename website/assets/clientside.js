@@ -0,0 +1,182 @@
+// Clientside callbacks. Callbacks that only change the UI (modals, hidden elements, plotting data the browser already
+// has) run here, without a request to the server. Server callbacks are reserved for everything that needs the
+// database or secrets: task assignment and rating submission, questionnaire submission, leaderboard, and results.
+window.rmhChunks = window.rmhChunks || {};
+
+const DAY_MS = 86400000;
+
+// Parse a binary hydrograph chunk as written by chunks.write_chunks.
+function rmhParseChunk(buffer) {
+    const view = new DataView(buffer);
+    const headerLength = view.getUint32(0, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+    const nSeries = header.series.length;
+    const nSteps = (buffer.byteLength - 4 - headerLength) / 4 / nSeries;
+    const values = new Float32Array(buffer, 4 + headerLength, nSeries * nSteps);
+    const start = Date.parse(header.start);
+    const times = Array.from({length: nSteps}, (_, i) => start + i * header.step * DAY_MS);
+    const series = {};
+    header.series.forEach((id, i) => {
+        series[id] = Array.from(values.subarray(i * nSteps, (i + 1) * nSteps), v => isNaN(v) ? null : v);
+    });
+    return {times: times, dates: times.map(t => new Date(t).toISOString().slice(0, 10)), series: series};
+}
+
+// Plotly dates look like "2014-01-24 11:20:55.1978" and are meant as UTC.
+function rmhParseDate(date) {
+    const iso = String(date).replace(' ', 'T');
+    return Date.parse(iso.length > 10 ? iso + 'Z' : iso);
+}
+
+// Visible x range of the current task's figure, or null if the user didn't zoom.
+function rmhVisibleRange(relayoutData, figure, key) {
+    if (!figure || !figure.layout || figure.layout.uirevision !== key) {
+        return null;  // the figure still shows the previous task
+    }
+    if (relayoutData && relayoutData['xaxis.autorange']) {
+        return null;
+    }
+    if (relayoutData && relayoutData['xaxis.range[0]'] !== undefined) {
+        return [relayoutData['xaxis.range[0]'], relayoutData['xaxis.range[1]']].map(rmhParseDate);
+    }
+    const xaxis = figure.layout.xaxis || {};
+    return xaxis.range && !xaxis.autorange ? xaxis.range.map(rmhParseDate) : null;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    rmh: {
+        // Open/close a modal with its open and close buttons.
+        toggle_modal: function(nOpen, nClose, isOpen) {
+            if (nOpen || nClose) {
+                return !isOpen;
+            }
+            return isOpen;
+        },
+
+        hide_without_user: function(userId) {
+            return userId === null || userId === undefined || userId === '';
+        },
+
+        hide_focus_freetext: function(focusAreas) {
+            return !focusAreas || !focusAreas.includes('other');
+        },
+
+        // Extract the axis ranges and y scale from the rating plot. Plotly updates the figure's layout in place when
+        // the user zooms or switches the scale, so we only send this small summary to the server instead of the
+        // whole figure.
+        axes_state: function(relayoutData, figure) {
+            if (!figure || !figure.layout) {
+                return null;
+            }
+            const xaxis = figure.layout.xaxis || {};
+            const yaxis = figure.layout.yaxis || {};
+            return {
+                x_range: xaxis.range,
+                y_range: yaxis.range,
+                y_autorange: yaxis.autorange,
+                y_scale: yaxis.type,
+            };
+        },
+
+        // Assemble the rating figure from the hydrograph chunks of the current task. Chunks are immutable and served
+        // with long-lived cache headers, so repeated views come from the browser cache. If the task window has more
+        // than plot.max_points days, we plot the finest downsampled chunk that fits and fetch the full-resolution
+        // chunks of the visible years once the user zooms in far enough. Clientside callbacks can't wait for the
+        // download, so we return no_update and click the hidden chunks-loaded button once all chunks are available,
+        // which calls this function again.
+        hydrograph_figure: function(plot, nLoaded, relayoutData, figure) {
+            if (!plot) {
+                return null;
+            }
+            const key = plot.chunks.map(chunk => chunk[1]).concat(plot.series).join(',');
+            const windowStart = Date.parse(plot.window[0]);
+            const windowEnd = Date.parse(plot.window[1]);
+            const windowDays = (windowEnd - windowStart) / DAY_MS + 1;
+
+            let coarse = null;
+            let years = plot.chunks;
+            if (windowDays > plot.max_points) {
+                const fitting = plot.pyramid.filter(level => 2 * windowDays / level[0] <= plot.max_points);
+                coarse = fitting.length > 0 ? fitting[0] : plot.pyramid[plot.pyramid.length - 1];
+                const visible = rmhVisibleRange(relayoutData, figure, key) || [windowStart, windowEnd];
+                const visibleDays = (visible[1] - visible[0]) / DAY_MS + 1;
+                years = visibleDays > plot.max_points ? [] : plot.chunks.filter(
+                    chunk => Date.UTC(chunk[0], 0, 1) <= visible[1] && Date.UTC(chunk[0] + 1, 0, 1) > visible[0]);
+            }
+
+            const urls = (coarse ? [coarse[1]] : []).concat(years.map(chunk => chunk[1]));
+            const missing = urls.filter(url => !(url in window.rmhChunks));
+            if (missing.length > 0) {
+                Promise.all(missing.map(url => fetch(url)
+                    .then(response => {
+                        // a missing or stale chunk returns an error page, which must not be parsed as hydrograph data
+                        if (!response.ok) {
+                            throw new Error(`${url}: HTTP ${response.status}`);
+                        }
+                        return response.arrayBuffer();
+                    })
+                    .then(buffer => { window.rmhChunks[url] = rmhParseChunk(buffer); })))
+                    .then(() => document.getElementById('chunks-loaded').click())
+                    .catch(error => console.error('Could not load hydrographs', error));
+                return window.dash_clientside.no_update;
+            }
+            // nothing to do if the figure already shows the required chunks (e.g., zooming within the same years)
+            const signature = urls.join(',');
+            if (window.rmhPlotSignature === signature && figure && figure.layout && figure.layout.uirevision === key) {
+                return window.dash_clientside.no_update;
+            }
+            window.rmhPlotSignature = signature;
+
+            // downsampled data outside the full-resolution years, full-resolution data inside them
+            const dates = [];
+            const ys = plot.series.map(() => []);
+            const append = (chunk, keep) => chunk.times.forEach((t, i) => {
+                if (t >= windowStart && t <= windowEnd && keep(t)) {
+                    dates.push(chunk.dates[i]);
+                    plot.series.forEach((id, j) => ys[j].push(chunk.series[id][i]));
+                }
+            });
+            const rawStart = years.length > 0 ? Date.UTC(years[0][0], 0, 1) : Infinity;
+            const rawEnd = years.length > 0 ? Date.UTC(years[years.length - 1][0] + 1, 0, 1) : Infinity;
+            if (coarse) {
+                append(window.rmhChunks[coarse[1]], t => t < rawStart);
+            }
+            years.forEach(chunk => append(window.rmhChunks[chunk[1]], t => true));
+            if (coarse) {
+                append(window.rmhChunks[coarse[1]], t => t >= rawEnd);
+            }
+
+            const names = ['Q obs.', 'Model 1', 'Model 2'];
+            const data = ys.map((y, i) => ({
+                type: 'scatter',
+                x: dates,
+                y: y,
+                name: names[i],
+                line: i === 0 ? {color: plot.colors[i], dash: 'dot'} : {color: plot.colors[i]},
+                yaxis: 'y',
+            }));
+            const yMax = Math.max(...ys.map(y => Math.max(...y.filter(v => v !== null))));
+
+            const layout = {
+                // keep the user's zoom and scale when we replace the data of the same task
+                uirevision: key,
+                xaxis: {type: 'date', title: 'Date', range: plot.window, titlefont: {size: 16}},
+                yaxis: {type: plot.y_scale, title: 'Discharge (m³/s)', range: [0, yMax * 1.3], titlefont: {size: 16}},
+                updatemenus: [{
+                    type: 'buttons',
+                    direction: 'right',
+                    xanchor: 'left',
+                    yanchor: 'bottom',
+                    y: 1,
+                    x: 0,
+                    active: plot.y_scale === 'linear' ? 0 : 1,
+                    buttons: [
+                        {args: [{'yaxis.type': 'linear'}], label: 'Linear scale', method: 'relayout'},
+                        {args: [{'yaxis.type': 'log'}], label: 'Log scale', method: 'relayout'},
+                    ],
+                }],
+            };
+            return {data: data, layout: layout};
+        },
+    },
+});
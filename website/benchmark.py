@@ -0,0 +1,169 @@
+"""Load test with simulated raters to compare the capacity of the serving modes (uwsgi.ini vs. uwsgi-gevent.ini).
+
+Usage: `python benchmark.py http://localhost:9090 --user-id <id of a user in the database> [--raters 16 64 256]`
+
+Start the server with an HTTP socket on the same machine and database as in production, e.g.,
+`uwsgi --ini uwsgi.ini --http :9090` or `uwsgi --ini uwsgi-gevent.ini --http :9090`. Each simulated rater repeatedly
+submits a rating and gets the next task, the server callback that writes to the database, and then waits for
+`--think-time` seconds, like a rater who looks at the hydrographs. After every `--leaderboard-every` ratings, it also
+opens the leaderboard, a callback that runs three database queries. For each number of concurrent raters, the benchmark
+reports the throughput and latency percentiles. The capacity of a mode is the largest number of raters whose 95th
+latency percentile stays below what raters tolerate (e.g., one second).
+
+The ratings are stored for the given user, so use a test database or a test user and delete its ratings afterwards.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# outputs of the rating callback in apps/rate.py
+RATING_OUTPUTS = [
+    'state-plot.data', 'state-task.data', 'state-counter.data', 'task-description.children', 'rating-progress.value',
+    'rating-progress-label.children', 'rating-loading-output.value', 'modal-task-body.children', 'modal-task.is_open',
+    'location-dummy-rate.children'
+]
+
+
+def _callback_request(url: str, outputs: List[str], inputs: Dict[str, Any], state: Dict[str, Any],
+                      changed: str) -> urllib.request.Request:
+    """Request of a dash server callback, as the browser sends it. Properties are given as `<component id>.<name>`."""
+
+    def props(values: Dict[str, Any]) -> List[dict]:
+        return [{
+            'id': prop.split('.')[0],
+            'property': prop.split('.')[1],
+            'value': value
+        } for prop, value in values.items()]
+
+    payload = {
+        'output': f'..{"...".join(outputs)}..',
+        'outputs': [{'id': prop.split('.')[0], 'property': prop.split('.')[1]} for prop in outputs],
+        'inputs': props(inputs),
+        'changedPropIds': [changed],
+        'state': props(state),
+    }
+    return urllib.request.Request(f'{url.rstrip("/")}/_dash-update-component',
+                                  data=json.dumps(payload).encode('utf-8'),
+                                  headers={'Content-Type': 'application/json'})
+
+
+def leaderboard_request(url: str, user_id: str) -> urllib.request.Request:
+    return _callback_request(url, ['leaderboard_text.children', 'leaderboard_bar.value', 'leaderboard_bar.color'],
+                             inputs={'leaderboard_modal.is_open': True},
+                             state={'state-user.data': user_id},
+                             changed='leaderboard_modal.is_open')
+
+
+def rating_request(url: str, user_id: str, task_token: Optional[str], counter: int) -> urllib.request.Request:
+    """Submit a rating of the task `task_token` (model a wins) and get the next task, like a click on a rating button.
+
+    Without a task token, the request only assigns a task, like the first page load.
+    """
+    now_ms = int(time.time() * 1000)
+    changed = 'btn_model_a.n_clicks' if task_token is not None else 'state-user.modified_timestamp'
+    return _callback_request(url, RATING_OUTPUTS,
+                             inputs={
+                                 'btn_model_a.n_clicks': counter + 1 if task_token is not None else None,
+                                 'btn_model_b.n_clicks': None,
+                                 'btn_equal_good.n_clicks': None,
+                                 'btn_equal_bad.n_clicks': None,
+                                 'state-user.modified_timestamp': now_ms,
+                             },
+                             state={
+                                 'state-user.data': user_id,
+                                 'state-task.data': task_token,
+                                 'state-axes.data': None,
+                                 'state-counter.data': counter,
+                                 'state-counter.modified_timestamp': now_ms,
+                             },
+                             changed=changed)
+
+
+def run_level(url: str, user_id: str, n_raters: int, duration: float, think_time: float, timeout: float,
+              leaderboard_every: int) -> dict:
+    """Let `n_raters` raters send requests for `duration` seconds and summarize the latencies."""
+    latencies = {'rating': [], 'leaderboard': []}
+    errors = [0]
+    lock = threading.Lock()
+    end_time = time.monotonic() + duration
+
+    def send(kind: Optional[str], request: urllib.request.Request) -> Optional[dict]:
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                body = json.loads(response.read())
+        except (OSError, ValueError):
+            with lock:
+                errors[0] += 1
+            return None
+        if kind is not None:
+            with lock:
+                latencies[kind].append(time.monotonic() - start)
+        return body
+
+    def rater(rater_idx: int):
+        # spread the first requests over one think time, so the raters don't arrive all at once
+        time.sleep(think_time * rater_idx / n_raters)
+        # the first task assignment is not timed, it corresponds to loading the page
+        task_token, counter = None, -1
+        n_ratings = 0
+        while time.monotonic() < end_time:
+            rated = task_token is not None
+            body = send('rating' if rated else None, rating_request(url, user_id, task_token, counter))
+            response = (body or {}).get('response', {})
+            if 'state-task' in response:
+                task_token, counter = response['state-task']['data'], response['state-counter']['data']
+            n_ratings += rated
+            if rated and n_ratings % leaderboard_every == 0:
+                send('leaderboard', leaderboard_request(url, user_id))
+            time.sleep(think_time)
+
+    with ThreadPoolExecutor(max_workers=n_raters) as executor:
+        list(executor.map(rater, range(n_raters)))
+
+    all_latencies = np.array(latencies['rating'] + latencies['leaderboard']) * 1000
+    rating_latencies = np.array(latencies['rating']) * 1000
+    return {
+        'raters': n_raters,
+        'requests/s': len(all_latencies) / duration,
+        'p50 [ms]': np.percentile(all_latencies, 50) if len(all_latencies) > 0 else np.nan,
+        'p95 [ms]': np.percentile(all_latencies, 95) if len(all_latencies) > 0 else np.nan,
+        'p99 [ms]': np.percentile(all_latencies, 99) if len(all_latencies) > 0 else np.nan,
+        'rating p95': np.percentile(rating_latencies, 95) if len(rating_latencies) > 0 else np.nan,
+        'errors': errors[0],
+    }
+
+
+def main(args: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Measure how many concurrent raters the website can serve.')
+    parser.add_argument('url', help='Base URL of the website, e.g., http://localhost:9090')
+    parser.add_argument('--user-id', required=True, help='Id of an existing user, whose leaderboard is requested')
+    parser.add_argument('--raters', type=int, nargs='+', default=[16, 32, 64, 128, 256, 512])
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per number of raters')
+    parser.add_argument('--think-time', type=float, default=1.0, help='Seconds between two requests of a rater')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds until a request counts as error')
+    parser.add_argument('--leaderboard-every',
+                        type=int,
+                        default=5,
+                        help='Number of ratings after which a rater opens the leaderboard')
+    parsed = parser.parse_args(args)
+
+    columns = ['raters', 'requests/s', 'p50 [ms]', 'p95 [ms]', 'p99 [ms]', 'rating p95', 'errors']
+    print(' '.join(f'{c:>11}' for c in columns))
+    for n_raters in parsed.raters:
+        result = run_level(parsed.url, parsed.user_id, n_raters, parsed.duration, parsed.think_time, parsed.timeout,
+                           parsed.leaderboard_every)
+        print(' '.join(f'{result[c]:>11.1f}' if isinstance(result[c], float) else f'{result[c]:>11}'
+                       for c in columns))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
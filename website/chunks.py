@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import re
+import struct
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray
+from flask import abort, send_from_directory
+
+from app import CHUNK_DIR, server
+from task_token import model_id
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_ROUTE = '/hydrographs'
+OBS_SERIES_ID = 'obs'
+# chunks are content-addressed, so their URLs never change their content and can be cached forever
+CHUNK_MAX_AGE = 365 * 24 * 3600
+CHUNK_NAME_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# bucket sizes (in days) of the downsampled chunks. Must be even, since each bucket is stored as two values.
+PYRAMID_BUCKETS = [4, 16, 64]
+
+
+def write_chunks(hydrographs: xarray.DataArray, obs_name: str, models: List[str], years: List[int], basin_dim: str,
+                 date_dim: str,
+                 chunk_dir: Path) -> Tuple[Dict[Tuple[str, int], str], Dict[Tuple[str, int], str]]:
+    """Write binary chunks with the observations and all model simulations of each basin.
+
+    For each basin, we write one full-resolution chunk per calendar year, plus one downsampled chunk per bucket size in
+    `PYRAMID_BUCKETS` that covers all years (see `minmax_downsample`). The browser uses the downsampled chunks to plot
+    long time ranges and fetches the full-resolution chunks of the visible years when the user zooms in.
+
+    Each chunk is stored as `<content hash>.bin` with the following little-endian layout: uint32 header length,
+    JSON header (start date, step between values in days, and ids of the series, padded with spaces to a multiple of 4
+    bytes), and a float32 matrix of shape (series, steps). Model names are replaced by their keyed ids, so users can't
+    figure out which model is which. Existing chunks are not rewritten.
+
+    Parameters
+    ----------
+    hydrographs : xarray.DataArray
+        Daily discharge with dimensions model, basin, and date.
+    obs_name : str
+        Name of the observations in the model dimension.
+    models : List[str]
+        Models to include in the chunks.
+    years : List[int]
+        Calendar years to create chunks for.
+    basin_dim : str
+        Name of the basin dimension.
+    date_dim : str
+        Name of the date dimension.
+    chunk_dir : Path
+        Directory to store the chunks in.
+
+    Returns
+    -------
+    Tuple[Dict[Tuple[str, int], str], Dict[Tuple[str, int], str]]
+        Content hash of the full-resolution chunk for each (basin, year) and of the downsampled chunk for each
+        (basin, bucket size).
+    """
+    chunk_dir.mkdir(parents=True, exist_ok=True)
+    series = [obs_name] + list(models)
+    series_ids = [OBS_SERIES_ID] + [model_id(m) for m in models]
+    hydrographs = hydrographs.sel({
+        'model': series,
+        date_dim: slice(f'{min(years)}-01-01', f'{max(years)}-12-31')
+    }).transpose('model', basin_dim, date_dim)
+    values = hydrographs.values.astype('<f4')
+    dates = pd.DatetimeIndex(hydrographs[date_dim].values)
+    if not (dates[1:] - dates[:-1] == pd.Timedelta(days=1)).all():
+        raise ValueError('Dates are not contiguous daily steps')
+    basins = [str(b) for b in hydrographs[basin_dim].values]
+
+    year_chunks = {}
+    for year in years:
+        year_idx = np.flatnonzero(dates.year == year)
+        if len(year_idx) == 0:
+            LOGGER.warning(f'No data for year {year}, skipping chunks.')
+            continue
+        for basin_idx, basin in enumerate(basins):
+            year_chunks[(basin, int(year))] = _write_chunk(chunk_dir, dates[year_idx[0]], 1, series_ids,
+                                                           values[:, basin_idx, year_idx])
+
+    pyramid_chunks = {}
+    for bucket in PYRAMID_BUCKETS:
+        downsampled = minmax_downsample(values, bucket)
+        for basin_idx, basin in enumerate(basins):
+            pyramid_chunks[(basin, bucket)] = _write_chunk(chunk_dir, dates[0], bucket // 2, series_ids,
+                                                           downsampled[:, basin_idx])
+    return year_chunks, pyramid_chunks
+
+
+def minmax_downsample(values: np.ndarray, bucket: int) -> np.ndarray:
+    """Peak-preserving downsampling that keeps the minimum and maximum of each bucket along the last axis.
+
+    The two values of each bucket are ordered by their occurrence, so the downsampled hydrograph has the same peaks and
+    troughs as the original one. Missing values are ignored; buckets without any data are NaN.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Array with time as last axis.
+    bucket : int
+        Number of time steps per bucket. The last bucket is padded with NaNs if necessary.
+
+    Returns
+    -------
+    np.ndarray
+        Array with two values per bucket along the last axis.
+    """
+    n_buckets = -(-values.shape[-1] // bucket)
+    padded = np.full(values.shape[:-1] + (n_buckets * bucket,), np.nan, dtype=values.dtype)
+    padded[..., :values.shape[-1]] = values
+    padded = padded.reshape(values.shape[:-1] + (n_buckets, bucket))
+
+    missing = np.isnan(padded)
+    argmin = np.where(missing, np.inf, padded).argmin(axis=-1)
+    argmax = np.where(missing, -np.inf, padded).argmax(axis=-1)
+    minimum = np.take_along_axis(padded, argmin[..., None], axis=-1)[..., 0]
+    maximum = np.take_along_axis(padded, argmax[..., None], axis=-1)[..., 0]
+
+    min_first = argmin <= argmax
+    downsampled = np.stack([np.where(min_first, minimum, maximum), np.where(min_first, maximum, minimum)], axis=-1)
+    return downsampled.reshape(values.shape[:-1] + (2 * n_buckets,))
+
+
+def _write_chunk(chunk_dir: Path, start: pd.Timestamp, step: int, series_ids: List[str], values: np.ndarray) -> str:
+    header = json.dumps({'start': start.strftime('%Y-%m-%d'), 'step': step, 'series': series_ids}).encode('utf-8')
+    header += b' ' * (-len(header) % 4)
+    content = struct.pack('<I', len(header)) + header + np.ascontiguousarray(values, dtype='<f4').tobytes()
+    chunk_hash = hashlib.sha256(content).hexdigest()[:32]
+    chunk_file = chunk_dir / f'{chunk_hash}.bin'
+    if not chunk_file.exists():
+        chunk_file.write_bytes(content)
+    return chunk_hash
+
+
+def chunk_url(chunk_hash: str) -> str:
+    return f'{CHUNK_ROUTE}/{chunk_hash}.bin'
+
+
+@server.route(f'{CHUNK_ROUTE}/<chunk_hash>.bin')
+def serve_chunk(chunk_hash: str):
+    if not CHUNK_NAME_PATTERN.match(chunk_hash):
+        abort(404)
+    response = send_from_directory(Path(CHUNK_DIR).resolve(),
+                                   f'{chunk_hash}.bin',
+                                   mimetype='application/octet-stream',
+                                   etag=chunk_hash,
+                                   max_age=CHUNK_MAX_AGE,
+                                   conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
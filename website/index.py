@@ -1,14 +1,15 @@
 import logging
 
 import dash_bootstrap_components as dbc
-from dash import html, dcc, Input, Output, State
+from dash import ClientsideFunction, html, dcc, Input, Output, State
 from flask import send_from_directory
 
 # need to import server so we can expose it to uwsgi
 from app import app, db, server
 # "unused" imports are necessary to load the callbacks from these modules
-from apps import rate, questionnaire, instructions, leaderboard
+from apps import rate, questionnaire, instructions, leaderboard, results
 from database import User  # pylint: disable=unused-import
+import profiler  # pylint: disable=unused-import
 
 LOGGER = logging.getLogger(__name__)
 
@@ -94,17 +95,24 @@ welcome_back_page = dbc.Card(
 
 app.layout = base_layout
 
+# seed the live results with all ratings that are already in the database
+rate.OUTCOME_CUBE.refresh()
+# uwsgi forks the workers after this point. Release the session and close the master's database connections now, so no
+# worker inherits a socket that another process still uses; each worker opens its own connections.
+db.session.remove()
+db.engine.dispose()
 
-@app.callback(Output("help_modal", "is_open"), Input("help_open", "n_clicks"), Input("help_close", "n_clicks"),
-              State("help_modal", "is_open"))
-def toggle_help(n1, n2, is_open):
-    if n1 or n2:
-        return not is_open
-    return is_open
 
+app.clientside_callback(ClientsideFunction(namespace='rmh', function_name='toggle_modal'),
+                        Output("help_modal", "is_open"), Input("help_open", "n_clicks"), Input("help_close", "n_clicks"),
+                        State("help_modal", "is_open"))
 
-@app.callback(Output('page-content', 'children'), Input('url', 'pathname'), State('state-user', 'data'))
-def display_page(pathname: str, user_id: str):
+
+@app.callback(Output('page-content', 'children'), Input('url', 'pathname'), State('url', 'search'),
+              State('state-user', 'data'))
+def display_page(pathname: str, search: str, user_id: str):
+    if pathname == '/results' and results.is_admin(search):
+        return results.results_page
     if user_id is not None and user_id != '':
         user = User.query.filter_by(id=user_id).first()
         if user is not None:
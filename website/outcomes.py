@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import exc
+
+from database import Rating
+
+LOGGER = logging.getLogger(__name__)
+
+OUTCOMES = ['a_wins', 'b_wins', 'equal_good', 'equal_bad']
+TASKS = ['overall', 'high-flow', 'low-flow']
+# rating ids are assigned on insert but become visible on commit, so concurrent writers can commit them out of order.
+# refresh looks back this many ids behind the highest id it has seen for ratings that were committed late.
+LOOKBACK_IDS = 500
+
+
+class OutcomeCube:
+    """In-memory counts of rating outcomes per (model_a, model_b, task, objective).
+
+    The cube is seeded from the database on the first `refresh` and afterwards only fetches ratings it may not have
+    seen yet: all ids after the last gap-free id, at most `LOOKBACK_IDS` behind the highest id. Ids that were counted
+    in this window are remembered, so a rating that is committed after a rating with a higher id is still counted
+    exactly once. Ratings that are written by the current process can be added right away with `record`, so the
+    results page does not need to wait for the next refresh to show them. Since every uwsgi worker keeps its own cube,
+    `refresh` also picks up the ratings that were written by the other workers.
+
+    Parameters
+    ----------
+    models : List[str]
+        Names of the models that can appear as model_a or model_b.
+    objectives : List[str]
+        Names of the objectives.
+    tasks : List[str], optional
+        Names of the rating tasks.
+    min_refresh_interval : float, optional
+        Minimum number of seconds between two database queries of `refresh`. More frequent calls return right away.
+    """
+
+    def __init__(self,
+                 models: List[str],
+                 objectives: List[str],
+                 tasks: List[str] = None,
+                 min_refresh_interval: float = 5.0):
+        self.models = list(models)
+        self.objectives = list(objectives)
+        self.tasks = list(tasks if tasks is not None else TASKS)
+        self._model_idx = {m: i for i, m in enumerate(self.models)}
+        self._objective_idx = {o: i for i, o in enumerate(self.objectives)}
+        self._task_idx = {t: i for i, t in enumerate(self.tasks)}
+
+        self.counts = np.zeros((len(self.models), len(self.models), len(self.tasks), len(self.objectives),
+                                len(OUTCOMES)),
+                               dtype=np.int64)
+        self._lock = threading.Lock()
+        # all ratings with id <= _last_id are contained in the cube (or will never be committed). Counted ratings with
+        # a higher id are remembered in _counted_ids, so neither refresh nor record counts them twice.
+        self._last_id = 0
+        self._counted_ids = set()
+        self.min_refresh_interval = min_refresh_interval
+        self._last_refresh = None
+
+    def _add(self, rating_id: int, model_a: str, model_b: str, task: str, objective: str, outcome: int):
+        try:
+            idx = (self._model_idx[model_a], self._model_idx[model_b], self._task_idx[task],
+                   self._objective_idx[objective], outcome)
+        except KeyError:
+            LOGGER.warning(f'Ignoring rating {rating_id} with unknown model, task, or objective')
+            return
+        self.counts[idx] += 1
+
+    def record(self, rating: Rating):
+        """Add a rating that was just committed to the database.
+
+        Parameters
+        ----------
+        rating : Rating
+            The committed rating. Ratings without id (i.e., not committed) or without outcome are ignored.
+        """
+        outcome = _rating_outcome(rating.num_a_wins, rating.num_b_wins, rating.num_equal_good, rating.num_equal_bad)
+        if rating.id is None or outcome is None:
+            return
+        with self._lock:
+            if rating.id <= self._last_id or rating.id in self._counted_ids:
+                return
+            self._add(rating.id, rating.model_a, rating.model_b, rating.task, rating.objective, outcome)
+            self._counted_ids.add(rating.id)
+
+    def refresh(self, force: bool = False):
+        """Fetch the ratings from the database that the cube hasn't counted yet.
+
+        Parameters
+        ----------
+        force : bool, optional
+            Query the database even if the last refresh was less than `min_refresh_interval` seconds ago.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_refresh is not None and now - self._last_refresh < self.min_refresh_interval:
+                return
+            self._last_refresh = now
+            last_id = self._last_id
+        try:
+            rows = Rating.query.with_entities(Rating.id, Rating.model_a, Rating.model_b, Rating.task, Rating.objective,
+                                              Rating.num_a_wins, Rating.num_b_wins, Rating.num_equal_good,
+                                              Rating.num_equal_bad) \
+                .filter(Rating.id > last_id).order_by(Rating.id).all()
+        except exc.SQLAlchemyError as exception:
+            LOGGER.error(f'Could not refresh outcome cube: {exception}')
+            return
+
+        with self._lock:
+            for rating_id, model_a, model_b, task, objective, *outcome_counts in rows:
+                if rating_id <= self._last_id or rating_id in self._counted_ids:
+                    continue
+                outcome = _rating_outcome(*outcome_counts)
+                if outcome is not None:
+                    self._add(rating_id, model_a, model_b, task, objective, outcome)
+                # ratings without outcome or with unknown models are done as well, so they don't leave a gap in the ids
+                self._counted_ids.add(rating_id)
+            self._advance()
+        if last_id == 0:
+            LOGGER.info(f'Outcome cube seeded with {len(rows)} ratings.')
+
+    def _advance(self):
+        # move _last_id over the ids without gaps. Gaps can be ratings that are not committed yet, so they are only
+        # given up once they are more than LOOKBACK_IDS behind the highest counted id (e.g., rolled back inserts).
+        if len(self._counted_ids) == 0:
+            return
+        self._last_id = max(self._last_id, max(self._counted_ids) - LOOKBACK_IDS)
+        while self._last_id + 1 in self._counted_ids:
+            self._last_id += 1
+        self._counted_ids = {i for i in self._counted_ids if i > self._last_id}
+
+    def select(self, task: Optional[str] = None, objective: Optional[str] = None) -> np.ndarray:
+        """Get the outcome counts of one task/objective, or summed over all tasks/objectives.
+
+        Parameters
+        ----------
+        task : str, optional
+            Task to select. If None, counts are summed over all tasks.
+        objective : str, optional
+            Objective to select. If None, counts are summed over all objectives.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (models, models, outcomes) with the counts for each (model_a, model_b) pair.
+        """
+        with self._lock:
+            counts = self.counts.copy()
+        counts = counts[:, :, [self._task_idx[task]]] if task is not None else counts
+        counts = counts[:, :, :, [self._objective_idx[objective]]] if objective is not None else counts
+        return counts.sum(axis=(2, 3))
+
+    def rank(self, task: Optional[str] = None, objective: Optional[str] = None) -> pd.DataFrame:
+        """Calculate win/loss statistics for each model, sorted by win percentage.
+
+        Parameters
+        ----------
+        task : str, optional
+            Task to evaluate. If None, all tasks are combined.
+        objective : str, optional
+            Objective to evaluate. If None, all objectives are combined.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per model with the number of won and lost comparisons, the fraction of equally good and equally
+            bad ratings, the number of ratings, and the win percentage.
+        """
+        counts = self.select(task, objective)
+        a_wins, b_wins, equal_good, equal_bad = (counts[..., i] for i in range(len(OUTCOMES)))
+        won = a_wins.sum(axis=1) + b_wins.sum(axis=0)
+        lost = b_wins.sum(axis=1) + a_wins.sum(axis=0)
+        total = counts.sum(axis=(1, 2)) + counts.sum(axis=(0, 2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats = pd.DataFrame(
+                {
+                    'won': won,
+                    'lost': lost,
+                    'equal good': (equal_good.sum(axis=1) + equal_good.sum(axis=0)) / total,
+                    'equal bad': (equal_bad.sum(axis=1) + equal_bad.sum(axis=0)) / total,
+                    'number of ratings': total,
+                    'win%': 100 * won / (won + lost),
+                },
+                index=pd.Index(self.models, name='model'))
+        return stats.sort_values(by='win%')
+
+    def pairwise(self, task: Optional[str] = None, objective: Optional[str] = None) -> pd.DataFrame:
+        """Calculate the win percentage of each model (rows) against each other model (columns).
+
+        Parameters
+        ----------
+        task : str, optional
+            Task to evaluate. If None, all tasks are combined.
+        objective : str, optional
+            Objective to evaluate. If None, all objectives are combined.
+
+        Returns
+        -------
+        pd.DataFrame
+            Matrix of win percentages. Pairs without any decisive rating are NaN.
+        """
+        counts = self.select(task, objective)
+        won = counts[..., 0] + counts[..., 1].T
+        lost = counts[..., 1] + counts[..., 0].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matrix = 100 * won / (won + lost)
+        return pd.DataFrame(matrix, index=self.models, columns=self.models)
+
+    def n_ratings(self) -> int:
+        return int(self.counts.sum())
+
+
+def _rating_outcome(num_a_wins: int, num_b_wins: int, num_equal_good: int, num_equal_bad: int) -> Optional[int]:
+    # for every rating, at most one of the num_* columns is 1 (none of them for skipped ratings).
+    for i, num in enumerate([num_a_wins, num_b_wins, num_equal_good, num_equal_bad]):
+        if num:
+            return i
+    return None
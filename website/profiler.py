@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Dict
+
+from flask import g, jsonify, request
+
+from app import PROFILE_FRACTION, PROFILE_SLOW_MS, app, log_file, server
+from apps.results import is_admin
+from worker import rng
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILE_DIR = Path(log_file).parent / 'profiles'
+SAMPLE_INTERVAL_S = 0.005
+# the settings of the admin route are shared with all workers through this file
+SETTINGS_FILE = PROFILE_DIR / 'settings.json'
+SETTINGS_CHECK_INTERVAL_S = 1.0
+
+_SETTINGS = {'fraction': PROFILE_FRACTION, 'slow_ms': PROFILE_SLOW_MS, 'mtime': None, 'checked': 0.0}
+
+
+class Sampler:
+    """Background thread that periodically records the call stacks of the threads that are being profiled.
+
+    The thread only runs while at least one request is profiled, so the profiler costs nothing while it is switched
+    off. Stacks are stored in collapsed form (`outer;inner;innermost`), which flamegraph.pl and speedscope read.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between two samples.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stacks: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id: int):
+        """Start recording the stacks of a thread."""
+        with self._lock:
+            self._stacks[thread_id] = Counter()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id: int) -> Counter:
+        """Stop recording a thread and return the number of samples per collapsed stack."""
+        with self._lock:
+            return self._stacks.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if len(self._stacks) == 0:
+                    self._thread = None
+                    return
+                frames = sys._current_frames()  # pylint: disable=protected-access
+                for thread_id, stacks in self._stacks.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_collapse(frame)] += 1
+
+
+SAMPLER = Sampler(SAMPLE_INTERVAL_S)
+
+
+def settings() -> Dict[str, float]:
+    """Current profiler settings: the admin route's settings file if it exists, else the environment variables."""
+    now = time.monotonic()
+    if now - _SETTINGS['checked'] > SETTINGS_CHECK_INTERVAL_S:
+        _SETTINGS['checked'] = now
+        try:
+            mtime = SETTINGS_FILE.stat().st_mtime
+            if mtime != _SETTINGS['mtime']:
+                _SETTINGS.update(json.loads(SETTINGS_FILE.read_text()), mtime=mtime)
+        except FileNotFoundError:
+            if _SETTINGS['mtime'] is not None:
+                _SETTINGS.update(fraction=PROFILE_FRACTION, slow_ms=PROFILE_SLOW_MS, mtime=None)
+        except (OSError, ValueError) as exception:
+            LOGGER.error(f'Could not read profiler settings: {exception}')
+    return {'fraction': _SETTINGS['fraction'], 'slow_ms': _SETTINGS['slow_ms']}
+
+
+@server.route('/_profiler')
+def profiler_settings():
+    """Show or change the profiler settings of all workers.
+
+    `/_profiler?key=<ADMIN_KEY>&fraction=0.05&slow_ms=1000` profiles 5% of the callback requests plus every request
+    that takes longer than one second, `fraction=0&slow_ms=0` switches the profiler off, and `reset=1` returns to the
+    settings from the environment variables.
+    """
+    if not is_admin(request.query_string.decode('utf-8')):
+        return 'Not found', 404
+    current = settings()
+    if 'reset' in request.args:
+        SETTINGS_FILE.unlink(missing_ok=True)
+        current = {'fraction': PROFILE_FRACTION, 'slow_ms': PROFILE_SLOW_MS}
+    elif 'fraction' in request.args or 'slow_ms' in request.args:
+        try:
+            current = {name: float(request.args.get(name, current[name])) for name in ['fraction', 'slow_ms']}
+        except ValueError:
+            return 'fraction and slow_ms must be numbers', 400
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        # write and rename, so workers never read a half-written file
+        tmp_file = SETTINGS_FILE.with_suffix(f'.{os.getpid()}.tmp')
+        tmp_file.write_text(json.dumps(current))
+        tmp_file.replace(SETTINGS_FILE)
+        LOGGER.info(f'Profiler settings changed to {current}')
+    return jsonify(current)
+
+
+@server.before_request
+def start_profile():
+    if request.path != '/_dash-update-component':
+        return
+    current = settings()
+    sampled = current['fraction'] > 0 and rng().random() < current['fraction']
+    # we can only know whether a request is slow once it is done, so in this mode every callback is sampled
+    if sampled or current['slow_ms'] > 0:
+        g.profile = {'start': time.perf_counter(), 'sampled': sampled, 'slow_ms': current['slow_ms']}
+        SAMPLER.start(threading.get_ident())
+
+
+@server.teardown_request
+def stop_profile(_exception):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    stacks = SAMPLER.stop(threading.get_ident())
+    duration_ms = (time.perf_counter() - profile['start']) * 1000
+    is_slow = profile['slow_ms'] > 0 and duration_ms >= profile['slow_ms']
+    if (profile['sampled'] or is_slow) and len(stacks) > 0:
+        try:
+            _write_profile(_callback_name(), duration_ms, stacks)
+        except OSError as exception:
+            LOGGER.error(f'Could not write profile: {exception}')
+
+
+def _callback_name() -> str:
+    # dash identifies the callback of a request by its output(s)
+    output = (request.get_json(silent=True) or {}).get('output', 'unknown')
+    callback = app.callback_map.get(output, {}).get('callback')
+    return re.sub(r'[^\w.-]', '_', getattr(callback, '__name__', output))
+
+
+def _write_profile(callback: str, duration_ms: float, stacks: Counter):
+    profile_dir = PROFILE_DIR / callback
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    profile_file = profile_dir / f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{duration_ms:.0f}ms.folded'
+    profile_file.write_text(''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()))
+    LOGGER.info(f'Profiled {callback} ({duration_ms:.0f} ms, {sum(stacks.values())} samples): {profile_file}')
+
+
+def _collapse(frame: FrameType) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = '/'.join(Path(code.co_filename).parts[-2:])
+        names.append(f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
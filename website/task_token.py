@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+from typing import List, Optional
+
+from app import SALT
+
+LOGGER = logging.getLogger(__name__)
+
+# length of the truncated HMAC-SHA256 signature in bytes
+SIGNATURE_BYTES = 16
+
+
+def sign_task(task: list) -> str:
+    """Create a compact signed token that describes a rating task.
+
+    The task is stored in the browser as `<payload>.<signature>`, so the server can verify that a submitted rating
+    belongs to a task it created without keeping any per-user state.
+
+    Parameters
+    ----------
+    task : list
+        JSON-serializable description of the task.
+
+    Returns
+    -------
+    str
+        The signed token.
+    """
+    payload = _b64encode(json.dumps(task, separators=(',', ':')).encode('utf-8'))
+    return f'{payload}.{_b64encode(_signature(payload))}'
+
+
+def verify_task(token: Optional[str]) -> Optional[List]:
+    """Check the signature of a task token and decode the task.
+
+    Parameters
+    ----------
+    token : str
+        Token as created by `sign_task`.
+
+    Returns
+    -------
+    List
+        The decoded task, or None if the token is missing, malformed, or has an invalid signature.
+    """
+    if not isinstance(token, str) or token.count('.') != 1:
+        return None
+    payload, signature = token.split('.')
+    try:
+        if not hmac.compare_digest(_b64decode(signature), _signature(payload)):
+            LOGGER.warning(f'Encountered task token with invalid signature: {token}')
+            return None
+        task = json.loads(_b64decode(payload))
+    except ValueError:
+        LOGGER.warning(f'Encountered malformed task token: {token}')
+        return None
+    return task if isinstance(task, list) else None
+
+
+def model_id(model_name: str) -> str:
+    """Keyed short id of a model, so the user can't use browser dev tools to figure out the model names."""
+    return hmac.new(SALT.encode('utf-8'), model_name.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+
+
+def _signature(payload: str) -> bytes:
+    return hmac.new(SALT.encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
@@ -0,0 +1,91 @@
+import logging
+import os
+import threading
+from typing import Callable, List
+
+import numpy as np
+
+from app import server
+
+try:
+    import uwsgidecorators
+except ImportError:  # not running under uwsgi, e.g., with `python index.py`
+    uwsgidecorators = None
+
+LOGGER = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_SEED_SEQUENCE = np.random.SeedSequence()
+_SEED_PID = os.getpid()
+_WARMUP_FUNCTIONS: List[Callable[[], None]] = []
+
+
+def rng() -> np.random.Generator:
+    """Random number generator of the current worker process and thread.
+
+    uwsgi forks all workers from the master process, so they would share the state of a global generator. Instead, each
+    process draws fresh entropy from the OS after the fork, and each thread gets its own independent generator spawned
+    from it, so we never need to reseed during a request.
+
+    Returns
+    -------
+    np.random.Generator
+        Generator that must only be used by the calling thread.
+    """
+    generator = getattr(_LOCAL, 'generator', None)
+    if generator is None or _LOCAL.pid != os.getpid():
+        with _LOCK:
+            _reseed_after_fork()
+            seed = _SEED_SEQUENCE.spawn(1)[0]
+        _LOCAL.generator, _LOCAL.pid = np.random.default_rng(seed), os.getpid()
+        generator = _LOCAL.generator
+    return generator
+
+
+def on_worker_start(function: Callable[[], None]) -> Callable[[], None]:
+    """Register a function that warms up a cache in each new worker before it accepts requests.
+
+    Parameters
+    ----------
+    function : Callable[[], None]
+        Function without arguments.
+
+    Returns
+    -------
+    Callable[[], None]
+        The unchanged function, so this can be used as decorator.
+    """
+    _WARMUP_FUNCTIONS.append(function)
+    return function
+
+
+def init_worker():
+    """Prepare a freshly forked worker: new randomness and warm caches."""
+    with _LOCK:
+        _reseed_after_fork()
+    # the master closes its database connections before the fork (see index.py). Disposing the inherited pool here would
+    # close sockets that are shared with the master, so each worker simply starts with the empty pool.
+
+    for function in _WARMUP_FUNCTIONS:
+        try:
+            function()
+        except Exception as exception:
+            # a cold cache is not a reason to fail the worker, it just makes the first request slower
+            LOGGER.error(f'Worker warm-up {function.__name__} failed: {exception}')
+
+    # dash sets up its routes and serializes the layout and callback graph on the first request of each process
+    client = server.test_client()
+    for route in ['/_dash-layout', '/_dash-dependencies']:
+        client.get(route)
+    LOGGER.info(f'Worker {os.getpid()} ready.')
+
+
+def _reseed_after_fork():
+    global _SEED_SEQUENCE, _SEED_PID
+    if _SEED_PID != os.getpid():
+        _SEED_SEQUENCE, _SEED_PID = np.random.SeedSequence(), os.getpid()
+
+
+if uwsgidecorators is not None:
+    uwsgidecorators.postfork(init_worker)